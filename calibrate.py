@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+
+# © 2020 University of Oxford - Department of Physics
+# Physics Practical Course AS35 - Colour-magnitude diagrams of open clusters
+# Photometric calibration against a reference catalogue
+
+# Import Python Libraries
+import numpy as np
+from scipy.spatial import cKDTree
+
+
+def read_catalogue(filename):
+	'''
+	Read a reference catalogue with columns RA Dec B V (degrees, magnitudes),
+	optionally followed by the errors of B and V.
+	Returns a dictionary of arrays.
+	'''
+	data = np.atleast_2d(np.loadtxt(filename))
+	catalogue = {"ra": data[:,0], "dec": data[:,1], "B": data[:,2], "V": data[:,3]}
+	if data.shape[1] >= 6:
+		catalogue["B_err"] = data[:,4]
+		catalogue["V_err"] = data[:,5]
+	else:
+		catalogue["B_err"] = np.zeros(len(data))
+		catalogue["V_err"] = np.zeros(len(data))
+	return catalogue
+
+
+def unit_vectors(ra, dec):
+	# Cartesian coordinates on the unit sphere, so that the tree distances are
+	# valid over the whole sky
+	ra = np.radians(ra)
+	dec = np.radians(dec)
+	return np.array([np.cos(dec)*np.cos(ra), np.cos(dec)*np.sin(ra), np.sin(dec)]).T
+
+
+def cross_match(ra, dec, ref_ra, ref_dec, radius=2.0):
+	'''
+	Nearest reference star of every star within radius (arcsec), with a KD-tree.
+	Returns the indices of the matched stars and of their reference stars.
+	'''
+	tree = cKDTree(unit_vectors(ref_ra, ref_dec))
+	chord = 2*np.sin(np.radians(radius/3600.)/2)
+	distance, nearest = tree.query(unit_vectors(ra, dec), distance_upper_bound=chord)
+	matched = np.nonzero(np.isfinite(distance))[0]
+	return matched, nearest[matched]
+
+
+def solve(inst_mag, ref_mag, colour, airmass, errors=None, extinction=0., sigma=3.0, maxiters=5):
+	'''
+	Fit ref_mag - inst_mag = zeropoint + colour_term*colour - extinction*airmass
+	by weighted least squares with iterative sigma clipping, for the zeropoint
+	and the colour term. The extinction coefficient is fixed: the stars of a
+	combined image all have the same airmass, which cannot separate the
+	extinction from the zeropoint.
+	Returns a dictionary with the coefficients, their errors, the rms and the
+	number of stars used.
+	'''
+	inst_mag = np.asarray(inst_mag, dtype=np.float64)
+	delta = np.asarray(ref_mag, dtype=np.float64) - inst_mag
+	colour = np.asarray(colour, dtype=np.float64)
+	airmass = np.broadcast_to(np.asarray(airmass, dtype=np.float64), delta.shape)
+	if errors is None:
+		errors = np.ones(len(delta))
+	weights = 1./np.maximum(np.asarray(errors, dtype=np.float64), 1e-3)
+
+	valid = np.isfinite(delta) & np.isfinite(colour) & np.isfinite(airmass) & np.isfinite(weights)
+	good = valid
+
+	# Design matrix: zeropoint and colour term
+	design = np.array([np.ones(len(delta)), colour]).T
+	target = delta + extinction*airmass
+
+	nparams = design.shape[1]
+	if np.count_nonzero(good) <= nparams:
+		return None
+
+	for iteration in range(maxiters + 1):
+		coeffs, _, _, _ = np.linalg.lstsq(design[good]*weights[good,None], target[good]*weights[good], rcond=None)
+		residuals = target - np.dot(design, coeffs)
+		rms = np.sqrt(np.mean(residuals[good]**2))
+		# Clip against a robust scatter, so that bright outliers do not hide;
+		# the stars clipped by a fit biased by the outliers come back afterwards
+		std = 1.4826*np.median(np.abs(residuals[good] - np.median(residuals[good])))
+		keep = valid & (np.abs(residuals) <= sigma*max(std, 1e-3))
+		if iteration == maxiters or np.array_equal(keep, good) or np.count_nonzero(keep) <= nparams:
+			break
+		good = keep
+
+	# Errors of the coefficients, scaled by the scatter of the residuals
+	weighted = design[good]*weights[good,None]
+	covariance = np.linalg.pinv(np.dot(weighted.T, weighted))
+	chi2 = np.sum((residuals[good]*weights[good])**2)/max(np.count_nonzero(good) - nparams, 1)
+	coeff_errors = np.sqrt(np.diag(covariance)*chi2)
+
+	return {
+		"zeropoint": float(coeffs[0]),
+		"zeropoint_err": float(coeff_errors[0]),
+		"colour_term": float(coeffs[1]),
+		"colour_term_err": float(coeff_errors[1]),
+		"extinction": float(extinction),
+		"rms": float(rms),
+		"nstars": int(np.count_nonzero(good)),
+	}
+
+
+def apply(inst_b, inst_v, airmass_b, airmass_v, solution_b, solution_v):
+	'''
+	Calibrated B and V magnitudes of all the stars at once. The colour terms
+	depend on the calibrated colour, which is solved for exactly:
+	(B-V) = ((b-v) + ZB - ZV - kB XB + kV XV)/(1 - cB + cV).
+	'''
+	bv = (np.asarray(inst_b) - np.asarray(inst_v) + solution_b["zeropoint"] - solution_v["zeropoint"] - solution_b["extinction"]*airmass_b + solution_v["extinction"]*airmass_v)/(1. - solution_b["colour_term"] + solution_v["colour_term"])
+	mag_v = inst_v + solution_v["zeropoint"] + solution_v["colour_term"]*bv - solution_v["extinction"]*airmass_v
+	return mag_v + bv, mag_v
+
+
+def calibrate(ra, dec, inst_b, inst_v, airmass_b, airmass_v, catalogue, errors_b=None, errors_v=None, radius=2.0, extinction_b=0., extinction_v=0.):
+	'''
+	Cross-match the stars with the reference catalogue, solve for the
+	calibration of each filter, with the given extinction coefficients, and
+	apply it to all the stars.
+	Returns the calibrated B and V magnitudes and the solutions of both filters.
+	'''
+	stars, refs = cross_match(ra, dec, catalogue["ra"], catalogue["dec"], radius)
+	ref_colour = catalogue["B"][refs] - catalogue["V"][refs]
+
+	def total_errors(inst_errors, ref_errors):
+		if inst_errors is None:
+			return None
+		return np.sqrt(np.asarray(inst_errors)[stars]**2 + ref_errors**2)
+
+	solution_b = solve(np.asarray(inst_b)[stars], catalogue["B"][refs], ref_colour, airmass_b, total_errors(errors_b, catalogue["B_err"][refs]), extinction_b)
+	solution_v = solve(np.asarray(inst_v)[stars], catalogue["V"][refs], ref_colour, airmass_v, total_errors(errors_v, catalogue["V_err"][refs]), extinction_v)
+	if solution_b is None or solution_v is None:
+		return None, None, solution_b, solution_v
+
+	mag_b, mag_v = apply(inst_b, inst_v, airmass_b, airmass_v, solution_b, solution_v)
+	return mag_b, mag_v, solution_b, solution_v
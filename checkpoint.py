@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+
+# © 2020 University of Oxford - Department of Physics
+# Physics Practical Course AS35 - Colour-magnitude diagrams of open clusters
+# Atomic outputs and journals of the completed outputs of each stage
+
+# Import Python Libraries
+import os
+import json
+import hashlib
+from contextlib import contextmanager
+
+
+def checksum(filename):
+	'''
+	MD5 checksum of the contents of a file.
+	'''
+	md5 = hashlib.md5()
+	with open(filename, "rb") as f:
+		for block in iter(lambda: f.read(1 << 20), b""):
+			md5.update(block)
+	return md5.hexdigest()
+
+
+@contextmanager
+def atomic_write(filename):
+	'''
+	Temporary file name to write an output to, in the same directory and with
+	the same extension. It replaces the output only once it has been written
+	completely, so an interrupted run never leaves a truncated file behind.
+	'''
+	directory, name = os.path.split(filename)
+	temporary = os.path.join(directory, ".tmp" + str(os.getpid()) + "_" + name)
+	try:
+		yield temporary
+		os.replace(temporary, filename)
+	finally:
+		if os.path.exists(temporary):
+			os.remove(temporary)
+
+
+def write_fits(image, filename):
+	'''
+	Write a CCDData or an HDUList atomically, with the CHECKSUM and DATASUM
+	keywords in every header.
+	'''
+	hdulist = image.to_hdu() if hasattr(image, "to_hdu") else image
+	with atomic_write(filename) as temporary:
+		hdulist.writeto(temporary, checksum=True)
+
+
+def write_json(data, filename):
+	'''
+	Write a dictionary to a JSON file atomically.
+	'''
+	with atomic_write(filename) as temporary:
+		with open(temporary, "w") as f:
+			json.dump(data, f, indent=1)
+
+
+def valid_fits(filename):
+	'''
+	Whether a FITS file can be read and all its headers have checksums that
+	match the data.
+	'''
+	from astropy.io import fits
+
+	if os.path.isfile(filename) != True:
+		return False
+	try:
+		with fits.open(filename) as hdulist:
+			for hdu in hdulist:
+				if hdu.verify_checksum() != 1 or hdu.verify_datasum() != 1:
+					return False
+	except Exception:
+		return False
+	return True
+
+
+class Journal() :	# Outputs of a stage completed by previous runs
+
+	def __init__(self, stage, directory=".", resume=True):
+		'''
+		Journal of a stage, kept in <directory>/<stage>.journal. Without resume
+		the previous journal is ignored and every output is made again.
+		'''
+		self.filename = os.path.join(directory, stage + ".journal")
+		self.entries = {}
+		if resume:
+			self.entries = self.read()
+
+	def read(self):
+		'''
+		Entries saved in the journal file, empty if there is none.
+		'''
+		if os.path.isfile(self.filename) != True:
+			return {}
+		try:
+			with open(self.filename, "r") as f:
+				return json.load(f)
+		except ValueError:
+			return {}
+
+	def signature(self, inputs, settings=None):
+		'''
+		Size and modification time of the input files, and the settings used.
+		'''
+		files = dict((filename, [os.path.getsize(filename), os.path.getmtime(filename)]) for filename in inputs if os.path.isfile(filename))
+		return {"files": files, "settings": settings}
+
+	def done(self, output, inputs, settings=None):
+		'''
+		Whether output was made by a previous run from the same inputs and
+		settings, and is still valid: its FITS checksums, or for other files the
+		checksum recorded in the journal, match its contents.
+		'''
+		entry = self.entries.get(output)
+		if entry is None or entry["inputs"] != json.loads(json.dumps(self.signature(inputs, settings))):
+			return False
+		if output.endswith(".fits"):
+			return valid_fits(output)
+		return os.path.isfile(output) and checksum(output) == entry["checksum"]
+
+	def record(self, output, inputs, settings=None):
+		'''
+		Record a completed output, and save the journal. The journal file is read
+		again and only this entry is changed, so that the entries recorded
+		meanwhile by another run of the stage (e.g. watch.py while
+		reduce_frames.py runs) are kept.
+		'''
+		entry = {"inputs": self.signature(inputs, settings)}
+		if not output.endswith(".fits"):
+			entry["checksum"] = checksum(output)
+		self.entries[output] = entry
+		entries = self.read()
+		entries[output] = entry
+		write_json(entries, self.filename)
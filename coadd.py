@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+
+# © 2020 University of Oxford - Department of Physics
+# Physics Practical Course AS35 - Colour-magnitude diagrams of open clusters
+# Weighted co-addition of reprojected frames
+
+# Import Python Libraries
+import warnings
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy import ndimage
+
+
+class RunningCoadd() :	# Weighted mean accumulated one frame at a time
+
+	def __init__(self, shape):
+		self.sum = np.zeros(shape, dtype=np.float32)
+		self.weight = np.zeros(shape, dtype=np.float32)
+		self.variance = np.zeros(shape, dtype=np.float32)
+		self.nframes = 0
+
+	def add(self, data, weight, variance=None):
+		'''
+		Add a frame with its per-pixel weights (and optionally its variance).
+		Pixels that are not finite or have no weight are ignored.
+		'''
+		valid = np.isfinite(data) & np.isfinite(weight) & (weight > 0)
+		if variance is not None:
+			valid &= np.isfinite(variance)
+
+		w = np.where(valid, weight, 0.).astype(np.float32)
+		self.weight += w
+		self.sum += w*np.where(valid, data, 0.)
+		if variance is not None:
+			self.variance += w*w*np.where(valid, variance, 0.)
+		self.nframes += 1
+
+	def result(self):
+		'''
+		Returns the weighted mean, the weight map and the variance of the mean.
+		'''
+		with np.errstate(divide='ignore', invalid='ignore'):
+			mean = self.sum/self.weight
+			variance = self.variance/self.weight**2
+		mean[self.weight == 0] = np.nan
+		variance[self.weight == 0] = np.nan
+		return mean, self.weight, variance
+
+
+class ClippedCoadd() :	# Sigma clipped weighted mean in two passes over the frames
+
+	def __init__(self, shape, buffer_size=25, seed=0):
+		'''
+		The first pass (sample) keeps a random sample of at most buffer_size
+		values of each pixel, so the memory does not grow with the number of
+		frames. The second pass (add) accumulates the weighted mean of the
+		values within the clipping limits set from that sample.
+		'''
+		self.buffer = np.full((buffer_size,) + tuple(shape), np.nan, dtype=np.float32)
+		self.count = np.zeros(shape, dtype=np.int64)
+		self.variance_sum = np.zeros(shape, dtype=np.float32)
+		self.rng = np.random.default_rng(seed)
+		self.lower = None
+		self.upper = None
+		self.coadd = RunningCoadd(shape)
+
+	@property
+	def nframes(self):
+		return self.coadd.nframes
+
+	def sample(self, data, variance=None):
+		'''
+		First pass: add the finite values of a frame to the sample of each
+		pixel, replacing a random stored value once the buffer is full
+		(reservoir sampling), so every frame has the same chance to be kept.
+		'''
+		size = self.buffer.shape[0]
+		valid = np.isfinite(data)
+		if variance is not None:
+			valid &= np.isfinite(variance)
+			self.variance_sum += np.where(valid, variance, 0.)
+		y, x = np.nonzero(valid)
+		n = self.count[y, x]
+		slot = np.where(n < size, n, (self.rng.random(len(n))*(n + 1)).astype(np.int64))
+		keep = slot < size
+		self.buffer[slot[keep], y[keep], x[keep]] = data[y[keep], x[keep]]
+		self.count[y, x] += 1
+
+	def clip_limits(self, sigma=3., maxiters=5, block_rows=64):
+		'''
+		Set the clipping limits of each pixel from its sample: the median plus
+		or minus sigma times the scaled MAD, iterated until no value is
+		rejected. The scale is at least the mean noise of the frames when their
+		variances were given, so a sample of a few very similar values does not
+		reject good frames. The sample is freed afterwards.
+		'''
+		shape = self.count.shape
+		self.lower = np.full(shape, np.nan, dtype=np.float32)
+		self.upper = np.full(shape, np.nan, dtype=np.float32)
+		with np.errstate(divide='ignore', invalid='ignore'):
+			noise = np.sqrt(self.variance_sum/self.count)
+
+		for y1 in range(0, shape[0], block_rows):
+			y2 = min(y1 + block_rows, shape[0])
+			values = np.array(self.buffer[:, y1:y2])
+			with warnings.catch_warnings():
+				# pixels without any value
+				warnings.simplefilter("ignore", category=RuntimeWarning)
+				for iteration in range(maxiters + 1):
+					centre = np.nanmedian(values, axis=0)
+					scale = 1.4826*np.nanmedian(np.abs(values - centre), axis=0)
+					scale = np.fmax(scale, noise[y1:y2])
+					with np.errstate(invalid='ignore'):
+						outliers = np.abs(values - centre) > sigma*scale
+					if iteration == maxiters or not np.any(outliers):
+						break
+					values[outliers] = np.nan
+			self.lower[y1:y2] = centre - sigma*scale
+			self.upper[y1:y2] = centre + sigma*scale
+
+		self.buffer = None
+
+	def add(self, data, weight, variance=None):
+		'''
+		Second pass: add a frame to the weighted mean, ignoring its values
+		outside the clipping limits.
+		'''
+		with np.errstate(invalid='ignore'):
+			clipped = ~((data >= self.lower) & (data <= self.upper))
+		self.coadd.add(np.where(clipped, np.nan, data), weight, variance)
+
+	def result(self):
+		'''
+		Returns the weighted mean, the weight map and the variance of the mean.
+		'''
+		return self.coadd.result()
+
+
+def lowexposure_mask(exposure_map, size=15, fraction=0.5, nsamples=100000):
+	'''
+	Mask of the pixels whose size x size median filtered exposure is below
+	fraction times the median of the filtered map, as medfilt followed by a
+	threshold, without computing the median filter itself.
+
+	The median of a window is below a level when more than half of its pixels
+	are, so every comparison only needs a box count of the low pixels, which
+	uniform_filter computes with running sums independently of the window size.
+	The median of the filtered map is found exactly, so the mask is the same.
+	'''
+	npix = size*size
+
+	def below(level):
+		# medfilt pads the map with zeros, which count as low pixels
+		low = (exposure_map < level).astype(np.float32)
+		count = ndimage.uniform_filter(low, size, mode='constant', cval=float(level > 0))*npix
+		return count > npix//2 + 0.5
+
+	# The median of the filtered map is the mean of its two middle values,
+	# which are values of the map (or the zeros of the padding). Bracket them
+	# between the filtered values of a sub-sample of windows, then bisect the
+	# values of the map within the bracket, with exact counts of the filtered
+	# pixels below each candidate
+	windows = sliding_window_view(exposure_map, (size, size))
+	step = max(1, int(np.sqrt(windows.shape[0]*windows.shape[1]/nsamples)))
+	sampled = np.unique(np.median(windows[::step, ::step].reshape(-1, npix), axis=1))
+
+	def bisect(candidates, rank):
+		# Largest candidate with at most rank filtered pixels below it
+		lo = -1
+		hi = len(candidates) - 1
+		while lo < hi:
+			mid = (lo + hi + 1)//2
+			if np.count_nonzero(below(candidates[mid])) <= rank:
+				lo = mid
+			else:
+				hi = mid - 1
+		return lo
+
+	def order_statistic(rank):
+		# Search first around the sampled median, then over all the samples
+		# if the value falls outside that range
+		narrow = sampled[int(0.49*len(sampled)):int(0.51*len(sampled)) + 2]
+		i = bisect(narrow, rank)
+		if i < 0 or i == len(narrow) - 1:
+			narrow = sampled
+			i = bisect(narrow, rank)
+		lo = narrow[i] if i >= 0 else -np.inf
+		hi = narrow[i + 1] if i + 1 < len(narrow) else np.inf
+		candidates = np.unique(exposure_map[(exposure_map >= lo) & (exposure_map < hi)])
+		if lo <= 0 < hi:
+			candidates = np.union1d(candidates, [0.])
+		return candidates[bisect(candidates, rank)]
+
+	rank = (exposure_map.size - 1)//2
+	lower = order_statistic(rank)
+	upper = lower
+	if exposure_map.size % 2 == 0 and np.count_nonzero(below(np.nextafter(lower, np.inf))) <= rank + 1:
+		upper = order_statistic(rank + 1)
+	median = 0.5*(lower + upper)
+
+	return below(fraction*median)
@@ -5,14 +5,28 @@
 # Master Bias Generator
 
 # Import Python Libraries
+import os
+import sys
+import config
+
+# EDIT the settings in a run file (--config run.toml) or on the command line
+settings = config.load("combine_bias", {
+    "list_file": "bias_files.txt",
+    # Grid of regions (along y and x) used for the quality checks, and the
+    # deviation (in units of the scatter between frames) to reject a frame
+    "qa_grid": (4, 4),
+    "qa_nsigma": 5.0,
+}, "Combine the bias frames into master/master_bias.fits")
+list_file = settings.list_file
+qa_grid = settings.qa_grid
+qa_nsigma = settings.qa_nsigma
+
 import ccdproc
 from ccdproc import CCDData
 from astropy import units as u
 import numpy as np
-import os
-import sys
-
-list_file = "bias_files.txt"
+from qa import region_stats, check_frames, check_master, write_report
+from checkpoint import write_fits
 
 # Check that the bias_files exists
 if os.path.isfile(list_file) != True:
@@ -25,6 +39,8 @@ if not os.path.exists("master"):
 
 # Read the bias files
 bias_list = []
+bias_names = []
+bias_stats = []
 for bias in open(list_file, "r"):
     bias = bias.strip()
     if len(bias) == 0 or bias[0] == "#":
@@ -42,25 +58,37 @@ for bias in open(list_file, "r"):
         print ("ERROR: The " + bias + " file does not seem to be a bias file")
         sys.exit()
 
+    # Statistics of its regions for the quality checks
+    bias_stats.append(region_stats(ccd.data, qa_grid))
+
     bias_list.append(ccd)
+    bias_names.append(bias)
 
 # Check that there is at least 1 bias to be combined
 if len(bias_list) == 0:
     print ("ERROR: " + list_file + " does not contain any valid file")
     sys.exit()
 
+# Check the bias frames and reject the outliers before combining them
+frames_report, flags = check_frames(bias_stats, bias_names, qa_nsigma)
+for name, flag in zip(bias_names, flags):
+    if flag:
+        print ("WARNING: The " + name + " file differs from the other bias frames and will not be combined")
+bias_list = [ccd for ccd, flag in zip(bias_list, flags) if not flag]
+if len(bias_list) == 0:
+    print ("ERROR: all the bias frames listed in " + list_file + " were rejected by the quality checks")
+    sys.exit()
+
 # Combine the bias
 master_bias = ccdproc.combine(bias_list, method='average', dtype="float32")
 
-# Calculate the mean and the standard deviation in the area delimited by (x1,y1) (x2,y2)
-# EDIT the values of x1, x2, y1, and y2
-x1 = 400
-x2 = 700
-y1 = 141
-y2 = 142
-print ("mean = ", np.mean(master_bias.data[y1:y2, x1:x2]))
-print ("std = ", np.std(master_bias.data[y1:y2, x1:x2]))
+# Calculate the clipped statistics in a grid of regions of the master bias
+master_report = check_master(master_bias.data, qa_grid)
+print ("mean = ", master_report["mean"])
+print ("std = ", master_report["std"])
+write_report("master_bias", master_report, frames_report, "master/qa_bias.json", "master/qa_bias.html")
+print ("Quality report saved in master/qa_bias.json and master/qa_bias.html")
 
 # Save the master bias
-master_bias.write("master/master_bias.fits", overwrite=True)
+write_fits(master_bias, "master/master_bias.fits")
 print ("Created master_bias.fits")
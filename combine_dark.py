@@ -5,15 +5,27 @@
 # Combine Dark Frames
 
 # Import Python Libraries
+import os.path
+import sys
+import config
+
+# EDIT the settings in a run file (--config run.toml) or on the command line
+settings = config.load("combine_dark", {
+	"list_file": "dark_files.txt",
+	# Grid of regions (along y and x) used for the quality checks, and the
+	# deviation (in units of the scatter between frames) to reject a frame
+	"qa_grid": (4, 4),
+	"qa_nsigma": 5.0,
+}, "Combine the dark frames and report their statistics")
+list_file = settings.list_file
+qa_grid = settings.qa_grid
+qa_nsigma = settings.qa_nsigma
+
 import ccdproc
 from ccdproc import CCDData
 from astropy import units as u
-from astropy.stats import sigma_clipped_stats
 import numpy as np
-import os.path
-import sys
-
-list_file = "dark_files.txt"
+from qa import region_stats, check_frames, check_master, write_report
 
 # Check that file exists
 if os.path.isfile(list_file) != True:
@@ -22,6 +34,8 @@ if os.path.isfile(list_file) != True:
 
 # Read the dark files
 dark_list = []
+dark_names = []
+dark_stats = []
 for dark in open(list_file, "r"):
 	dark = dark.strip()
 	if len(dark) == 0 or dark[0] == "#":
@@ -39,26 +53,38 @@ for dark in open(list_file, "r"):
 		print ("ERROR: The " + dark + " file does not seem to be a dark file")
 		sys.exit()
 
+	# Statistics of its regions for the quality checks
+	dark_stats.append(region_stats(ccd.data, qa_grid))
+
 	dark_list.append(ccd)
+	dark_names.append(dark)
 
 # Check that there is at least 1 dark to be combined
 if len(dark_list) == 0:
 	print ("ERROR: " + list_file + " does not contain any valid file")
 	sys.exit()
 
+# Check the dark frames and reject the outliers before combining them
+frames_report, flags = check_frames(dark_stats, dark_names, qa_nsigma)
+for name, flag in zip(dark_names, flags):
+	if flag:
+		print ("WARNING: The " + name + " file differs from the other dark frames and will not be combined")
+dark_list = [ccd for ccd, flag in zip(dark_list, flags) if not flag]
+if len(dark_list) == 0:
+	print ("ERROR: all the dark frames listed in " + list_file + " were rejected by the quality checks")
+	sys.exit()
+
 # Combine the dark
 master_dark = ccdproc.combine(dark_list, method='average', dtype="float32")
 
-# Calculate the mean and the standard deviation in the area delimited by (x1,y1) (x2,y2)
-# EDIT the values of x1, x2, y1, and y2
-x1 = 400
-x2 = 700
-y1 = 141
-y2 = 142
-mean, median, std = sigma_clipped_stats(master_dark.data[y1:y2,x1:x2], sigma=3.0, maxiters=5)
-
-print ("mean = ", mean)
-print ("std = ", std)
+# Calculate the clipped statistics in a grid of regions of the master dark
+master_report = check_master(master_dark.data, qa_grid)
+print ("mean = ", master_report["mean"])
+print ("std = ", master_report["std"])
+if not os.path.exists("master"):
+	os.makedirs("master")
+write_report("master_dark_raw", master_report, frames_report, "master/qa_dark_raw.json", "master/qa_dark_raw.html")
+print ("Quality report saved in master/qa_dark_raw.json and master/qa_dark_raw.html")
 
 # Read the exposure time from the FITS header
 print ("EXPTIME = ", master_dark.header["EXPTIME"])
@@ -6,13 +6,33 @@
 
 # Import Python Libraries
 import glob, os
+import sys
+import config
+
+# EDIT the settings in a run file (--config run.toml) or on the command line
+settings = config.load("combine_dark_final", {
+	"list_file": "dark_files.txt",
+	# Grid of regions (along y and x) used for the quality checks, and the
+	# deviation (in units of the scatter between frames) to reject a frame
+	"qa_grid": (4, 4),
+	"qa_nsigma": 5.0,
+	# Threshold (in units of the clipped standard deviation of the master
+	# dark) above which a pixel is marked as hot
+	"hot_nsigma": 10.0,
+}, "Combine the bias subtracted dark frames into master/master_dark.fits")
+list_file = settings.list_file
+qa_grid = settings.qa_grid
+qa_nsigma = settings.qa_nsigma
+hot_nsigma = settings.hot_nsigma
+
 import ccdproc
 from ccdproc import CCDData
 from astropy import units as u
+from astropy.io import fits
 import numpy as np
-import sys
-
-list_file = "dark_files.txt"
+from cosmics import hot_pixels
+from qa import region_stats, check_frames, check_master, write_report
+from checkpoint import write_fits
 
 # Check that file exists
 if os.path.isfile(list_file) != True:
@@ -30,6 +50,8 @@ master_bias.data = master_bias.data - 0 + 0
 
 # Read the dark files
 dark_list = []
+dark_names = []
+dark_stats = []
 for dark in open(list_file, "r"):
 	dark = dark.strip()
 	if len(dark) == 0 or dark[0] == "#":
@@ -50,19 +72,43 @@ for dark in open(list_file, "r"):
 	# and subtract the master bias
 	ccd = ccdproc.subtract_bias(ccd, master_bias)
 
+	# Statistics of its regions for the quality checks
+	dark_stats.append(region_stats(ccd.data, qa_grid))
+
 	dark_list.append(ccd)
+	dark_names.append(dark)
 
 # Check that there is at least 1 dark to be combined
 if len(dark_list) == 0:
 	print ("ERROR: " + list_file + " does not contain any valid file")
 	sys.exit()
 
+# Check the dark frames and reject the outliers before combining them
+frames_report, flags = check_frames(dark_stats, dark_names, qa_nsigma)
+for name, flag in zip(dark_names, flags):
+	if flag:
+		print ("WARNING: The " + name + " file differs from the other dark frames and will not be combined")
+dark_list = [ccd for ccd, flag in zip(dark_list, flags) if not flag]
+if len(dark_list) == 0:
+	print ("ERROR: all the dark frames listed in " + list_file + " were rejected by the quality checks")
+	sys.exit()
+
 # Combine the dark
 master_dark = ccdproc.combine(dark_list, method='median', dtype="float32")
 
+# Calculate the clipped statistics in a grid of regions of the master dark
+master_report = check_master(master_dark.data, qa_grid)
+write_report("master_dark", master_report, frames_report, "master/qa_dark.json", "master/qa_dark.html")
+print ("Quality report saved in master/qa_dark.json and master/qa_dark.html")
+
 exptime = master_dark.header["EXPTIME"]
 print ("EXPTIME = ", exptime)
 
 # Save the master dark
-master_dark.write("master/master_dark.fits".format(exptime), overwrite=True)
+write_fits(master_dark, "master/master_dark.fits")
 print ("Created master_dark.fits")
+
+# Save the hot pixel mask, used to mask these pixels in every science frame
+mask_hot = hot_pixels(master_dark.data, nsigma=hot_nsigma)
+write_fits(fits.HDUList([fits.PrimaryHDU(mask_hot.astype(np.uint8))]), "master/hot_pixels.fits")
+print ("Created hot_pixels.fits with " + str(np.count_nonzero(mask_hot)) + " hot pixels")
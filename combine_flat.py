@@ -6,17 +6,31 @@
 
 # Import Python Libraries
 import glob, os
+import sys
+import config
+
+# EDIT the settings in a run file (--config run.toml) or on the command line
+settings = config.load("combine_flat", {
+	"list_file": "flat_files.txt",
+	# Grid of regions (along y and x) used for the quality checks, and the
+	# deviation (in units of the scatter between frames) to reject a frame
+	"qa_grid": (4, 4),
+	"qa_nsigma": 5.0,
+}, "Combine the flat field frames of one filter into master/master_flat_<filter>.fits")
+list_file = settings.list_file
+qa_grid = settings.qa_grid
+qa_nsigma = settings.qa_nsigma
+
 import ccdproc
 from ccdproc import CCDData
 from astropy import units as u
 import numpy as np
-import sys
+from qa import region_stats, check_frames, check_master, write_report
+from checkpoint import write_fits
 import warnings
 from astropy.utils.exceptions import AstropyWarning
 warnings.simplefilter('ignore', category=AstropyWarning)
 
-list_file = "flat_files.txt"
-
 # Check that the flat list exists
 if os.path.isfile(list_file) != True:
 	print ("ERROR: " + list_file + " does not exist")
@@ -41,6 +55,8 @@ master_dark = CCDData.read("master/master_dark.fits")
 
 # Read the flat files
 flat_list = []
+flat_names = []
+flat_stats = []
 filter_name = None
 for flat in open(list_file, "r"):
 	flat = flat.strip()
@@ -69,17 +85,34 @@ for flat in open(list_file, "r"):
 	# Normalize the flat field
 	ccd.data = ccd.data/np.median(ccd.data)
 	
+	# Statistics of its regions for the quality checks
+	flat_stats.append(region_stats(ccd.data, qa_grid))
+
 	flat_list.append(ccd)
+	flat_names.append(flat)
 	
 # Check that there is at least 1 dark to be combined
 if len(flat_list) == 0:
 	print ("ERROR: " + list_file + " does not contain any valid file")
 	sys.exit()
 	
+# Check the normalised flats and reject the outliers before combining them
+frames_report, flags = check_frames(flat_stats, flat_names, qa_nsigma)
+for name, flag in zip(flat_names, flags):
+	if flag:
+		print ("WARNING: The " + name + " file differs from the other flat frames and will not be combined")
+flat_list = [ccd for ccd, flag in zip(flat_list, flags) if not flag]
+if len(flat_list) == 0:
+	print ("ERROR: all the flat frames listed in " + list_file + " were rejected by the quality checks")
+	sys.exit()
+
 # Combine the flats
 master_flat = ccdproc.combine(flat_list, method='median', dtype="float32")
 
 # Save the master flat
 filter_name = ccd.header["FILTER"].strip()
-master_flat.write("master/master_flat_" + filter_name + ".fits", clobber=True)
+master_report = check_master(master_flat.data, qa_grid)
+write_report("master_flat_" + filter_name, master_report, frames_report, "master/qa_flat_" + filter_name + ".json", "master/qa_flat_" + filter_name + ".html")
+print ("Quality report saved in master/qa_flat_" + filter_name + ".json and master/qa_flat_" + filter_name + ".html")
+write_fits(master_flat, "master/master_flat_" + filter_name + ".fits")
 print ("Created master_flat_" + filter_name + ".fits")
\ No newline at end of file
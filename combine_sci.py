@@ -7,54 +7,105 @@
 # Import Python Libraries
 import glob, os
 import sys
+import config
+
+# EDIT the settings in a run file (--config run.toml) or on the command line
+settings = config.load("combine_sci", {
+	# Name of the cluster and the filters you want to image
+	"target": "NGC0663",
+	"filters": ["B", "V"],
+	# Combination method: "median", "mean" (weighted mean with running sums)
+	# or "clipped" (weighted mean with iterative sigma clipping)
+	"combine_method": "median",
+	# and the weights for the mean: "exposure" or "variance" (inverse variance)
+	"weighting": "exposure",
+	"clip_sigma": 3.0,
+	"clip_maxiters": 5,
+	# Number of values of each pixel kept to set the clipping limits
+	"clip_buffer": 25,
+	# Whether to refine the WCS of the frames by matching their bright stars,
+	# and the minimum number of matched stars to accept a frame
+	"register": True,
+	"min_matches": 5,
+	# Size of the filter and fraction of the median exposure used to mask
+	# the pixels with low integration times
+	"lowexp_size": 15,
+	"lowexp_fraction": 0.5,
+	# Skip the filters already combined by a previous run from the same frames
+	"resume": True,
+}, "Reproject and combine the calibrated frames of a target into <target>_combined")
+target = settings.target
+filters = settings.filters
+combine_method = settings.combine_method
+weighting = settings.weighting
+clip_sigma = settings.clip_sigma
+clip_maxiters = settings.clip_maxiters
+register = settings.register
+min_matches = settings.min_matches
+
 import ccdproc
 import copy
 from ccdproc import CCDData
+from astropy.nddata import VarianceUncertainty
 from astropy.io import fits
 from astropy import wcs
+import astropy.wcs.utils
 from astropy import units as u
-from reproject import reproject_interp
 import numpy as np
-from scipy.signal import medfilt
+from coadd import RunningCoadd, ClippedCoadd, lowexposure_mask
+from register import register_frames, apply_correction
+from checkpoint import Journal, write_fits
 import warnings
 from astropy.utils.exceptions import AstropyWarning
 warnings.simplefilter('ignore', category=AstropyWarning)
 warnings.filterwarnings('ignore')
 
 
-# EDIT the name of the cluster and the filters you want to image
-target = "NGC0663"
-filters = ["B", "V"]
-
-# Create the output directory if needed
-if not os.path.exists(target + "_combined"):
-	os.makedirs(target + "_combined")
+def combine_filter(filter_name, reference):
+	# reproject is slow to import, and only needed here
+	from reproject import reproject_interp
 
-for filter_name in filters:
 	# Find science frames for this filter
-	sci_files = glob.glob(target + "_frames/" + target + "_" + filter_name + "_*.fits")
+	sci_files = sorted(glob.glob(target + "_frames/" + target + "_" + filter_name + "_*.fits"))
 
-	sci_list = []
+	# Measure the WCS corrections of the frames
+	corrections = {}
+	if reference is not None and len(sci_files) > 0:
+		registration = register_frames(sci_files, reference, cache_file=target + "_combined/registration.json")
+		for sci in list(sci_files):
+			dra, ddec, nmatch, noverlap = registration[sci]
+			if nmatch >= min_matches:
+				corrections[sci] = (dra, ddec)
+			elif noverlap < min_matches:
+				print ("WARNING: " + sci + " does not overlap the reference frame, using its header WCS")
+			else:
+				print ("WARNING: " + sci + " does not match the reference frame, skipping it")
+				sci_files.remove(sci)
+
+	headers = []
 	ra = []
 	dec = []
 	for sci in sci_files:
-		# Read the file
-		ccd = CCDData.read(sci)
+		# Read the header only, the frames are read one by one when reprojecting
+		header = fits.getheader(sci)
+		if sci in corrections:
+			header["CRVAL1"] += corrections[sci][0]
+			header["CRVAL2"] += corrections[sci][1]
 		# Store the coordinates of the frame corners
-		w = wcs.WCS(ccd.header)
+		w = wcs.WCS(header)
 		
 		(ra1, dec1) = w.wcs_pix2world(1, 1, 1)
-		(ra2, dec2) = w.wcs_pix2world(ccd.header["NAXIS1"], ccd.header["NAXIS2"], 1)
+		(ra2, dec2) = w.wcs_pix2world(header["NAXIS1"], header["NAXIS2"], 1)
 		
 		ra.append(ra1)
 		ra.append(ra2)
 		dec.append(dec1)
 		dec.append(dec2)
 
-		sci_list.append(ccd)
+		headers.append(header)
 	
 	# Check that there is at least 1 file to be combined
-	if len(sci_list) == 0:
+	if len(headers) == 0:
 		print ("ERROR: no frames found for target = " + target + " and filter = " + filter_name)
 		sys.exit()
 
@@ -67,11 +118,12 @@ for filter_name in filters:
 	mean_dec = 0.5*(max(dec) + min(dec))
 	
 	# Create reference header
-	ref_header = copy.copy(sci_list[0].header)
+	ref_header = copy.copy(headers[0])
 	dist_ra = (((min(ra) - max(ra))*np.cos(np.radians(mean_dec)))**2 + (mean_dec - mean_dec)**2)**0.5
 	dist_dec = (((mean_ra - mean_ra)*np.cos(np.radians(mean_dec)))**2 + (max(dec) - min(dec))**2)**0.5
 
-	pix_size = abs(ref_header["CD1_1"])
+	# Pixel scale of the first frame, whether its header has CD or PC and CDELT keywords
+	pix_size = wcs.utils.proj_plane_pixel_scales(wcs.WCS(headers[0]))[0]
 
 	npix_ra = int(dist_ra/pix_size)
 	npix_dec = int(dist_dec/pix_size)
@@ -83,39 +135,154 @@ for filter_name in filters:
 	
 	ref_header["NAXIS1"] = npix_ra
 	ref_header["NAXIS2"] = npix_dec
+	ref_wcs = wcs.WCS(ref_header)
+
+	# Prepare the combination
+	shape = (npix_dec, npix_ra)
+	if combine_method == "median":
+		sci_list = []
+		# Sum of the variances and number of frames contributing to each pixel
+		variance_sum = np.zeros(shape, dtype=np.float32)
+		nframes = np.zeros(shape, dtype=np.float32)
+	elif combine_method == "mean":
+		coadd = RunningCoadd(shape)
+	elif combine_method == "clipped":
+		coadd = ClippedCoadd(shape, buffer_size=settings.clip_buffer)
+	else:
+		print ("ERROR: unknown combination method " + combine_method)
+		sys.exit()
+
+	def project(sci):
+		'''
+		Read a frame and reproject its data and variance onto the reference grid.
+		'''
+		ccd = CCDData.read(sci)
+		if sci in corrections:
+			apply_correction(ccd, *corrections[sci])
+		frame_wcs = ccd.wcs
+		ccd.data, footprint = reproject_interp((ccd.data, frame_wcs), ref_header)
+
+		variance = None
+		if ccd.uncertainty is not None:
+			variance, _ = reproject_interp((ccd.uncertainty.represent_as(VarianceUncertainty).array, frame_wcs), ref_header)
+			variance = variance.astype(np.float32)
+			# drop it, so that it is not carried through the combination
+			ccd.uncertainty = None
+		ccd.wcs = ref_wcs
+		return ccd, variance, footprint
+
+	# The clipping limits come from a first pass over the frames, which only
+	# keeps a bounded sample of the values of each pixel
+	if combine_method == "clipped":
+		for i, sci in enumerate(sci_files):
+			print ("sampling" + str(i+1) + "/" + str(len(sci_files)))
+			ccd, variance, footprint = project(sci)
+			coadd.sample(ccd.data, variance)
+		coadd.clip_limits(sigma=clip_sigma, maxiters=clip_maxiters)
 
 	#Reproject the frames
-	exposure_map = np.zeros((npix_dec, npix_ra))
-	for i, ccd in enumerate(sci_list):
-		print ("projecting" + str(i+1) + "/" + str(len(sci_list)))
-		ccd.data, _ = reproject_interp((ccd.data, ccd.header), ref_header)
+	exposure_map = np.zeros(shape)
+	for i, sci in enumerate(sci_files):
+		print ("projecting" + str(i+1) + "/" + str(len(sci_files)))
+		ccd, variance, footprint = project(sci)
 		
-		exptime, _ = reproject_interp((np.zeros_like(ccd.data) + ccd.header["EXPTIME"], ccd.header), ref_header)
+		exptime = footprint*ccd.header["EXPTIME"]
 		mask_exptime = (~np.isfinite(exptime)) + ~(np.isfinite(ccd.data))
 		exptime[mask_exptime] = 0.
 		exposure_map = exposure_map + exptime
-		
-		# and mask nan values
-		ccd.mask = (~(np.isfinite(ccd.data)))
+
+		# Weights of this frame for the weighted mean
+		if weighting == "variance" and variance is not None:
+			with np.errstate(divide='ignore'):
+				weight = 1./variance
+		else:
+			weight = exptime
+
+		if combine_method == "median":
+			if variance is not None:
+				valid = np.isfinite(variance) & np.isfinite(ccd.data)
+				variance[~valid] = 0.
+				variance_sum += variance
+				nframes += valid
+			# and mask nan values
+			ccd.mask = (~(np.isfinite(ccd.data)))
+			sci_list.append(ccd)
+		else:
+			coadd.add(ccd.data, weight, variance)
 
 	# Combine all the frames
-	combined_image = ccdproc.combine(sci_list, method='median', dtype="float32")
+	if combine_method == "median":
+		combined_image = ccdproc.combine(sci_list, method='median', dtype="float32")
+		weight_map = exposure_map
+
+		# Variance of the median, approximated as pi/2 times the variance of the mean
+		if np.any(nframes > 0):
+			with np.errstate(divide='ignore', invalid='ignore'):
+				variance_sum *= np.float32(0.5*np.pi)
+				variance_sum /= nframes**2
+			variance_sum[nframes == 0] = np.nan
+			combined_image.uncertainty = VarianceUncertainty(variance_sum)
+		else:
+			combined_image.uncertainty = None
+	else:
+		mean, weight_map, variance = coadd.result()
+		combined_image = CCDData(mean, unit=u.adu/u.s, header=ref_header)
+		if np.any(np.isfinite(variance)):
+			combined_image.uncertainty = VarianceUncertainty(variance)
+
 	# Save the combined frame
 	hdu = combined_image.to_hdu()
+	hdu.append(fits.ImageHDU(np.array(weight_map, dtype=np.float32), name="WEIGHT"))
 	hdu[0].header["CRVAL1"] = mean_ra
 	hdu[0].header["CRPIX1"] = npix_ra*0.5
 	hdu[0].header["CRVAL2"] = mean_dec
 	hdu[0].header["CRPIX2"] = npix_dec*0.5
-	
+
+	# Exposure weighted airmass of the frames, for the photometric calibration
+	airmasses = np.array([header.get("AIRMASS", np.nan) for header in headers], dtype=float)
+	exptimes = np.array([header.get("EXPTIME", 1.) for header in headers], dtype=float)
+	if np.any(np.isfinite(airmasses)):
+		good = np.isfinite(airmasses)
+		hdu[0].header["AIRMASS"] = (float(np.sum(airmasses[good]*exptimes[good])/np.sum(exptimes[good])), "Exposure weighted mean airmass")
+
 	# Mask pixel with low integration times
-	exposure_map = medfilt(exposure_map, (15, 15)) # but keep bright stars
-	mask_lowexposure = (exposure_map < np.median(exposure_map)*0.5)
+	mask_lowexposure = lowexposure_mask(exposure_map, size=settings.lowexp_size, fraction=settings.lowexp_fraction) # but keep bright stars
 	
 	hdu[0].data[mask_lowexposure] = np.nan
+	if "UNCERT" in hdu:
+		hdu["UNCERT"].data[mask_lowexposure] = np.nan
 	
-	hdu.writeto(target + "_combined/" + target + "_" + filter_name + "_combined.fits", clobber=True)
+	write_fits(hdu, target + "_combined/" + target + "_" + filter_name + "_combined.fits")
 	
 	#hdu[0].data = exposure_map
 	#hdu.writeto(target + "_combined/" + target + "_" + filter_name + "_combined_expmap.fits", clobber=True)
 	
 	print ("Created " + target + "_combined/" + target + "_" + filter_name + "_combined.fits")
+
+
+# Worker processes may import this script, so only the main process combines
+if __name__ == "__main__":
+	# Create the output directory if needed
+	if not os.path.exists(target + "_combined"):
+		os.makedirs(target + "_combined")
+
+	# Register all the filters against the same reference frame, so that
+	# the combined images are aligned with each other
+	reference = None
+	if register:
+		frames = sorted(glob.glob(target + "_frames/" + target + "_" + filters[0] + "_*.fits"))
+		if len(frames) > 0:
+			reference = frames[0]
+
+	# Skip the filters combined by a previous run from the same frames and
+	# settings, whose checksums are still valid
+	journal = Journal("combine_sci", target + "_combined", settings.resume)
+	parameters = [combine_method, weighting, clip_sigma, clip_maxiters, settings.clip_buffer, register, min_matches, settings.lowexp_size, settings.lowexp_fraction, reference]
+	for filter_name in filters:
+		output = target + "_combined/" + target + "_" + filter_name + "_combined.fits"
+		inputs = sorted(glob.glob(target + "_frames/" + target + "_" + filter_name + "_*.fits"))
+		if journal.done(output, inputs, parameters):
+			print ("Skipping " + output + ", already combined")
+			continue
+		combine_filter(filter_name, reference)
+		journal.record(output, inputs, parameters)
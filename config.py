@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+# © 2020 University of Oxford - Department of Physics
+# Physics Practical Course AS35 - Colour-magnitude diagrams of open clusters
+# Run configuration shared by all the scripts
+
+# Import Python Libraries
+# Only light modules are imported here, so that every script can parse its
+# settings (and answer --help) before importing astropy, photutils, etc.
+import argparse
+import os
+import sys
+
+
+def read_run_file(filename):
+	'''
+	Read a TOML (or YAML, if PyYAML is installed) run file into a dictionary.
+	'''
+	if filename.endswith(".yaml") or filename.endswith(".yml"):
+		import yaml
+		with open(filename, "r") as f:
+			return yaml.safe_load(f) or {}
+
+	try:
+		import tomllib
+	except ImportError:
+		import tomli as tomllib
+	with open(filename, "rb") as f:
+		return tomllib.load(f)
+
+
+def parse_value(text):
+	'''
+	Convert a command line value of a setting without a typed default.
+	'''
+	if text.lower() in ["none", "null"]:
+		return None
+	if text.lower() in ["true", "false"]:
+		return text.lower() == "true"
+	for convert in [int, float]:
+		try:
+			return convert(text)
+		except ValueError:
+			pass
+	return text
+
+
+def load(stage, defaults, description=None, argv=None, positional=()):
+	'''
+	Settings of a stage, returned as an argparse.Namespace.
+
+	The defaults are overridden by the top-level keys and then by the [stage]
+	section of the run file given with --config (or the AS35_CONFIG environment
+	variable), and finally by the command line options --<setting> <value>.
+	Settings listed in positional can also be given as positional arguments.
+	'''
+	if argv is None:
+		argv = sys.argv[1:]
+
+	parser = argparse.ArgumentParser(prog=stage, description=description)
+	parser.add_argument("--config", default=os.environ.get("AS35_CONFIG"), help="TOML or YAML run file")
+
+	# Read the run file first, as it provides the defaults of the options
+	prescan = argparse.ArgumentParser(add_help=False)
+	prescan.add_argument("--config", default=os.environ.get("AS35_CONFIG"))
+	known, _ = prescan.parse_known_args(argv)
+	settings = dict(defaults)
+	if known.config is not None:
+		if os.path.isfile(known.config) != True:
+			print ("ERROR: " + known.config + " does not exist")
+			sys.exit()
+		run = read_run_file(known.config)
+		section = run.get(stage, {})
+		for key in section:
+			if key not in defaults:
+				print ("ERROR: unknown setting " + key + " in section [" + stage + "] of " + known.config)
+				sys.exit()
+		for key in defaults:
+			if key in run and not isinstance(run[key], dict):
+				settings[key] = run[key]
+			if key in section:
+				settings[key] = section[key]
+
+	for key, default in defaults.items():
+		option = "--" + key
+		value = settings[key]
+		if isinstance(default, bool):
+			parser.add_argument(option, default=value, action=argparse.BooleanOptionalAction)
+		elif isinstance(default, (list, tuple)):
+			kind = type(default[0]) if len(default) > 0 else str
+			nargs = len(default) if isinstance(default, tuple) else "+"
+			parser.add_argument(option, default=value, type=kind, nargs=nargs, metavar=key.upper())
+		elif default is None:
+			parser.add_argument(option, default=value, type=parse_value)
+		else:
+			parser.add_argument(option, default=value, type=type(default))
+		if key in positional:
+			parser.add_argument(key + "_arg", nargs="?", default=None, metavar=key)
+
+	args = parser.parse_args(argv)
+
+	# Positional arguments take precedence over the options
+	for key in positional:
+		value = getattr(args, key + "_arg")
+		delattr(args, key + "_arg")
+		if value is not None:
+			setattr(args, key, value)
+
+	# Tuples stay tuples when read from the run file or the command line
+	for key, default in defaults.items():
+		if isinstance(default, tuple):
+			setattr(args, key, tuple(getattr(args, key)))
+
+	return args
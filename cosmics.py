@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+
+# © 2020 University of Oxford - Department of Physics
+# Physics Practical Course AS35 - Colour-magnitude diagrams of open clusters
+# Cosmic-ray and hot pixel detection
+
+# Import Python Libraries
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy import ndimage
+
+
+def subsampled_laplacian(data):
+	'''
+	Positive part of the Laplacian of the image subsampled 2x2, averaged back
+	to the original pixels (van Dokkum 2001). Inside each 2x2 block the
+	subsampled pixels are equal, so every corner only sees two neighbours and
+	the subsampled image never needs to be built.
+	'''
+	padded = np.pad(data, 1, mode='edge')
+	north = padded[:-2, 1:-1]
+	south = padded[2:, 1:-1]
+	west = padded[1:-1, :-2]
+	east = padded[1:-1, 2:]
+	twice = 2*data
+	laplacian = np.zeros_like(data)
+	for a in (north, south):
+		for b in (west, east):
+			corner = twice - a - b
+			np.clip(corner, 0, None, out=corner)
+			laplacian += corner
+	laplacian *= 0.25
+	return laplacian
+
+
+def median_at(data, y, x, size):
+	'''
+	Median filter of size x size pixels, evaluated only at the pixels (y, x).
+	'''
+	half = size//2
+	padded = np.pad(data, half, mode='edge')
+	windows = sliding_window_view(padded, (size, size))
+	values = np.empty(len(y), dtype=data.dtype)
+	for i in range(0, len(y), 10000):
+		values[i:i+10000] = np.median(windows[y[i:i+10000], x[i:i+10000]], axis=(1, 2))
+	return values
+
+
+def fine_structure(data, y, x):
+	'''
+	Fine structure image, med3 - med7(med3), evaluated only at the pixels (y, x).
+	'''
+	padded = np.pad(data, 4, mode='edge')
+	fine = np.empty(len(y), dtype=data.dtype)
+	for i in range(0, len(y), 10000):
+		windows = sliding_window_view(padded, (9, 9))[y[i:i+10000], x[i:i+10000]]
+		med3 = np.median(sliding_window_view(windows, (3, 3), axis=(1, 2)), axis=(-2, -1))
+		fine[i:i+10000] = med3[:, 3, 3] - np.median(med3, axis=(1, 2))
+	return fine
+
+
+def detect_cosmics(data, variance, sigclip=5.0, sigfrac=0.3, objlim=5.0):
+	'''
+	Mask of the pixels hit by cosmic rays, using the Laplacian edge detection
+	of L.A.Cosmic (van Dokkum 2001) in a single pass:
+	- the significance S = L+/2N, minus its 5x5 median to remove the
+	  large structures, S' = S - med5(S), must be above sigclip;
+	- S' must be above objlim times the fine structure relative to the noise,
+	  F/N, so that the cores of well sampled stars are not taken for hits;
+	- the neighbours of the hits with S' above sigclip, and then their
+	  neighbours above sigfrac*sigclip, are added to the mask.
+	The noise N comes from the variance plane instead of a median filtered
+	noise model. Since S >= S', the median filters and the fine structure are
+	only computed at the pixels where S is above the thresholds, so the cost
+	is a few array operations.
+	'''
+	image = np.array(data, dtype=np.float32)
+	bad = ~np.isfinite(image)
+	if np.any(bad):
+		image[bad] = np.nanmedian(image[::4, ::4])
+	noise = np.sqrt(np.asarray(variance, dtype=np.float32))
+	noise[~np.isfinite(noise) | (noise <= 0)] = np.inf
+
+	laplacian = subsampled_laplacian(image)
+	significance = laplacian/(2*noise)
+	mask = np.zeros(image.shape, dtype=bool)
+
+	def above(y, x, threshold):
+		# Pixels (y, x) whose S' is above the threshold
+		keep = significance[y, x] > threshold
+		y = y[keep]
+		x = x[keep]
+		sharp = significance[y, x] - median_at(significance, y, x, 5)
+		keep = sharp > threshold
+		return y[keep], x[keep], sharp[keep]
+
+	# Candidates that are sharper than the stars around them
+	y, x = np.nonzero(significance > sigclip)
+	y, x, sharp = above(y, x, sigclip)
+	if len(y) == 0:
+		return mask
+	fine = fine_structure(image, y, x)/noise[y, x]
+	fine = np.maximum(fine, 0.01)
+	cosmic = sharp/fine > objlim
+	mask[y[cosmic], x[cosmic]] = True
+
+	# Grow the cosmic rays into their neighbours above the same threshold,
+	# and then into the neighbours of those above the lower one
+	if np.any(cosmic):
+		for threshold in (sigclip, sigfrac*sigclip):
+			y, x = np.nonzero(ndimage.binary_dilation(mask, structure=np.ones((3, 3))) & ~mask)
+			y, x, sharp = above(y, x, threshold)
+			mask[y, x] = True
+
+	mask &= ~bad
+	return mask
+
+
+def hot_pixels(dark, nsigma=10.0, sigma=3.0, maxiters=5):
+	'''
+	Mask of the hot pixels of a master dark: pixels above the clipped median
+	by more than nsigma times the clipped standard deviation.
+	'''
+	values = np.asarray(dark, dtype=np.float32)
+	sample = values[np.isfinite(values)]
+	for iteration in range(maxiters):
+		median = np.median(sample)
+		std = np.std(sample)
+		keep = np.abs(sample - median) <= sigma*std
+		if np.all(keep):
+			break
+		sample = sample[keep]
+	return np.isfinite(values) & (values > median + nsigma*std)
@@ -7,25 +7,35 @@
 # Import Python Libraries
 import glob, os
 import sys
+import config
+
+# EDIT the settings in a run file (--config run.toml) or on the command line
+settings = config.load("find_stars", {
+	# Name of the cluster and the filter name (B or V)
+	"target": "NGC0663",
+	"ref_filter": "V",
+	# FWHM (pixels) of the stars and detection threshold (in sigma)
+	"fwhm": 3.0,
+	"threshold": 10.0,
+	# Whether to plot the detected stars over the image
+	"plot": True,
+	# Largest size (pixels) of the plotted image
+	"plot_size": 2000,
+}, "Detect the stars in a combined image and save their coordinates")
+target = settings.target
+ref_filter = settings.ref_filter
+
 from astropy.stats import sigma_clipped_stats
 from astropy.io import fits
 from photutils import DAOStarFinder
-import matplotlib.pyplot as plt
-from astropy.visualization import SqrtStretch
-from astropy.visualization.mpl_normalize import ImageNormalize
-from photutils import CircularAperture, CircularAnnulus
-from photutils import aperture_photometry
 from astropy import wcs
 import numpy as np
+from checkpoint import atomic_write
 import warnings
 from astropy.utils.exceptions import AstropyWarning
 warnings.simplefilter('ignore', category=AstropyWarning)
 warnings.filterwarnings('ignore')
 
-# EDIT the name of the cluster and the filter name
-target = "NGC0663"
-ref_filter = "V" # B or V
-
 
 def find_stars(target, filter_name):
 	filename = target + "_combined/" + target + "_" + filter_name + "_combined.fits"
@@ -43,8 +53,8 @@ def find_stars(target, filter_name):
 	# Compute the noise level
 	mean, median, std = sigma_clipped_stats(data, sigma=3.0, iters=5)
 	
-	# Find stars above 10sigma
-	daofind = DAOStarFinder(fwhm=3.0, threshold=10*std)
+	# Find stars above the threshold (10 sigma by default)
+	daofind = DAOStarFinder(fwhm=settings.fwhm, threshold=settings.threshold*std)
 	sources = daofind(data - median)
 
 	print ("Found " + str(len(sources)) + " sources")
@@ -53,14 +63,21 @@ def find_stars(target, filter_name):
 	ypix = sources['ycentroid']
 	
 	# Plot the stars in the image
-	pixpos = list(zip(xpix,ypix))
-	apertures = CircularAperture(pixpos, r=5)
-	norm = ImageNormalize(vmin=-std, vmax=20.*std, stretch=SqrtStretch())
-	plt.close()
-	plt.imshow(data, cmap='Greys', origin='lower', norm=norm)
-	apertures.plot(color="red", lw=1.5, alpha=0.5)
-	plt.savefig(target + "_filter_" + filter_name + ".png", dpi=250)
-	print ("Sources plotted in " + target + "_filter_" + filter_name + ".png")
+	if settings.plot:
+		# matplotlib is slow to import, and only needed for the plot
+		import matplotlib.pyplot as plt
+		from astropy.visualization import SqrtStretch
+		from astropy.visualization.mpl_normalize import ImageNormalize
+		import render
+
+		# The image is downsampled for display and the sources are drawn as
+		# a single raster layer, so the plot time does not grow with their number
+		norm = ImageNormalize(vmin=-std, vmax=20.*std, stretch=SqrtStretch())
+		plt.close()
+		render.plot_image(plt.gca(), data, np.array(xpix), np.array(ypix), radius=5, norm=norm, max_size=settings.plot_size)
+		with atomic_write(target + "_filter_" + filter_name + ".png") as temporary:
+			plt.savefig(temporary, dpi=250)
+		print ("Sources plotted in " + target + "_filter_" + filter_name + ".png")
 	# Convert from pixel to sky coordinates
 	w = wcs.WCS(header)
 
@@ -71,5 +88,6 @@ def find_stars(target, filter_name):
 stars = find_stars(target, ref_filter)
 
 # Save the positions of the stars in a text file
-np.savetxt("stars_" + target + "_" + ref_filter + ".txt", stars)
+with atomic_write("stars_" + target + "_" + ref_filter + ".txt") as temporary:
+	np.savetxt(temporary, stars)
 print ("Coordinates saved in stars_" + target + "_" + ref_filter + ".txt")
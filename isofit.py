@@ -7,13 +7,14 @@
 # Import Python Libraries
 import math
 import numpy as np
-import matplotlib
-matplotlib.use('GTK3Agg')	# Added to force use of X display for forwarding ; FC 2020/04/28
-import matplotlib.pyplot as plt
+from scipy import ndimage
 import curses
 import time
 import sys
 import getopt
+import config
+import render
+from checkpoint import atomic_write
 
 
 class CMDdata() : 	# CMD data class
@@ -22,27 +23,56 @@ class CMDdata() : 	# CMD data class
 		self.name=name
 		self.v=[]
 		self.bv=[]		
+		self.verr=[]
+		self.bverr=[]
+		self.weight=[]
 	
-	def loaddata(self,datafile) : 
+	def loaddata(self,datafile,pmin=0.0) : 
 		try : 
 			f = open(datafile,"r")
 			self.name = datafile
+			ipmem = None
 			for line in f : 
 				if(line[0]=='#') : 	# Comment lines
+					# with the column names, e.g. the membership probabilities pmem
+					names = line[1:].split()
+					if 'pmem' in names : 
+						ipmem = names.index('pmem')
 					continue
 				data = line.split()
+				weight = 1.0
+				if ipmem is not None : 
+					weight = float(data[ipmem])
+					if weight < pmin : 
+						continue
 				# Modified to read in RA, DEC, B, V format produced for AS32 scripts.
-				self.add_point(data[2],data[3])
+				# with optional B and V errors
+				self.add_point(*data[2:6 if ipmem is None else min(6,ipmem)],weight=weight)
 		except : 
 			print ("Error loading data CMD from file " + datafile)
 		
-	def add_point(self,bmag,vmag) : 
+	def add_point(self,bmag,vmag,berr=None,verr=None,weight=1.0) : 
 		self.v.append(float(vmag))
 		self.bv.append(float(bmag)-float(vmag))
+		self.weight.append(float(weight))
+		if berr is not None and verr is not None : 
+			self.verr.append(float(verr))
+			self.bverr.append(math.hypot(float(berr),float(verr)))
 	
-	def plot(self) : 
+	def plot(self,max_points=20000,decimate=False) : 
+		import matplotlib.pyplot as plt
 		plt.clf()
-		plt.plot(self.bv, self.v,'.',label=self.name)
+		if len(self.v) > max_points and decimate : 
+			# or as a random subset of the stars, the same at every redraw
+			keep = render.decimate(len(self.v), max_points)
+			plt.plot(np.array(self.bv)[keep], np.array(self.v)[keep],'.',label=self.name + " (" + str(max_points) + " of " + str(len(self.v)) + " stars)")
+		elif len(self.v) > max_points : 
+			# Large CMDs are drawn as a density image, which is as fast as a few points
+			v = np.array(self.v)
+			vrange = [np.nanmin(v[np.isfinite(v)]) - 0.5, np.nanmax(v[np.isfinite(v)]) + 0.5]
+			render.plot_density(plt.gca(), self.bv, self.v, bins=(500,500), range=[[-2.0,3.0],vrange], label=self.name)
+		else : 
+			plt.plot(self.bv, self.v,'.',label=self.name)
 		plt.xlim(-2.0,3.0)
 		plt.gca().invert_yaxis()
 		plt.xlabel('B-V colour')
@@ -56,14 +86,37 @@ class CMDmodel(CMDdata) : 	# CMD model class
 		self.Z=Z
 		self.v=[]
 		self.bv=[]
+		self.imf=[]
 		self.R=3.0	#	Extinction coefficient in E(B-V) to A(V)
 	
-	def add_point(self,bmag,vmag) :
+	def add_point(self,bmag,vmag,imf=None) :
 #		print bmag,vmag,float(bmag)-float(vmag)
 		self.v.append(float(vmag))
 		self.bv.append(float(bmag)-float(vmag))	
+		if imf is not None : 
+			self.imf.append(float(imf))
+
+	def sample(self,step=0.01) :
+		'''
+		Points along the isochrone every step (mag) at most, weighted by the
+		number of stars between the masses of consecutive points (int_IMF),
+		i.e. the isochrone as a population of stars rather than a line.
+		'''
+		bv = np.array(self.bv)
+		v = np.array(self.v)
+		if len(self.imf) == len(self.v) : 
+			weight = np.clip(np.diff(np.array(self.imf)),0.0,None)
+		else : 
+			weight = np.ones(len(v)-1)
+		length = np.hypot(np.diff(bv),np.diff(v))
+		nsub = np.clip(np.ceil(length/step),1,1000).astype(int)
+		segment = np.repeat(np.arange(len(nsub)),nsub)
+		# Position of every sample inside its segment
+		t = (np.arange(len(segment)) - np.repeat(np.cumsum(nsub)-nsub,nsub) + 0.5)/nsub[segment]
+		return bv[segment] + t*np.diff(bv)[segment], v[segment] + t*np.diff(v)[segment], (weight/nsub)[segment]
 
 	def plot(self,dist=0.0,ext=0.0) :
+		import matplotlib.pyplot as plt
 		vcor=dist + (ext * self.R)
 		plt.plot(np.array(self.bv) + ext,np.array(self.v) + vcor,'-',lw=2)
 	
@@ -83,17 +136,18 @@ def loadmodels(modelfile="PadovaCMD.dat") :
 			age = data[1]
 			v = data[10]
 			b = data[9]
+			imf = data[16]
 			
 			fnd=0
 			for c in CMDs : 
 				if(c.age == age and c.Z == Z) :
-					c.add_point(b,v)
+					c.add_point(b,v,imf)
 					fnd=1
 
 			if(not fnd) :
 				CMDs.append(CMDmodel(age,Z))
 #				print "added new CMD"
-				CMDs[-1].add_point(b,v)
+				CMDs[-1].add_point(b,v,imf)
 #				print "added new point"
 		
 		f.close()
@@ -104,20 +158,33 @@ def loadmodels(modelfile="PadovaCMD.dat") :
 			
 	return CMDs
 
-def loaddata(datafile='CMD.dat') : 
+def loaddata(datafile='CMD.dat',pmin=0.0) : 
 	''' 
 	Loads a data file with format B-V, V
+	The stars with a membership probability (pmem column, see membership.py)
+	below pmin are skipped, the others are weighted by it.
 	''' 
 	cmd = CMDdata(datafile)
 	
 	try : 
 		f = open(datafile,"r")
+		ipmem = None
 		for line in f : 
 			if(line[0]=='#') : 	# Comment lines
+				# with the column names, e.g. the membership probabilities pmem
+				names = line[1:].split()
+				if 'pmem' in names : 
+					ipmem = names.index('pmem')
 				continue
 			data = line.split()
+			weight = 1.0
+			if ipmem is not None : 
+				weight = float(data[ipmem])
+				if weight < pmin : 
+					continue
 			# Modified to read in RA, DEC, B, V format produced for AS32 scripts.
-			cmd.add_point(data[2],data[3])
+			# with optional B and V errors
+			cmd.add_point(*data[2:6 if ipmem is None else min(6,ipmem)],weight=weight)
 	except : 
 		print ("Error loading data CMD from file " + datafile)
 		return
@@ -137,6 +204,98 @@ def chisq(cmd,model,dist,ext) :
 	return chisq/float(n)
 	
 
+class HessDiagram() : 	# Binned CMD for the likelihood fit
+	'''
+	Colour-magnitude histogram (Hess diagram) of the data, built once, and
+	Poisson likelihood of the models. The cost of a model does not depend on
+	the number of stars.
+
+	The model histograms are cached per model and reddening (quantized to
+	ext_step); a change of distance by a whole number of magnitude bins is a
+	shift of the histogram rows, so all the distances of a grid are compared
+	at once.
+	'''
+
+	def __init__(self,cmd,bvrange=(-0.5,2.5),binsize=(0.05,0.1),background=0.05,ext_step=0.025) :
+		bv = np.array(cmd.bv)
+		v = np.array(cmd.v)
+		# Stars weighted by their membership probabilities, if any
+		weight = np.array(cmd.weight) if len(cmd.weight) == len(cmd.v) else np.ones(len(v))
+		good = np.isfinite(bv) & np.isfinite(v) & (weight > 0)
+		self.dbv, self.dv = binsize
+		self.bv_edges = np.arange(bvrange[0],bvrange[1] + 0.5*self.dbv,self.dbv)
+		self.v_edges = np.arange(np.floor(np.min(v[good])/self.dv)*self.dv,np.max(v[good]) + self.dv,self.dv)
+		self.counts, _, _ = np.histogram2d(v[good],bv[good],bins=(self.v_edges,self.bv_edges),weights=weight[good])
+		self.nstars = np.sum(self.counts)
+		self.occupied = np.nonzero(self.counts)
+		self.background = background
+		self.ext_step = ext_step
+		self.cache = {}
+		# Broaden the models by the typical photometric errors, in bins
+		self.smooth = (0.0,0.0)
+		if len(cmd.verr) == len(cmd.v) and len(cmd.verr) > 0 :
+			self.smooth = (np.nanmedian(cmd.verr)/self.dv,np.nanmedian(cmd.bverr)/self.dbv)
+
+	def model_hist(self,model,ext) :
+		'''
+		Histogram of the model reddened by ext, on the magnitude bins of the
+		data extended to all the distances, and the index of its first row.
+		'''
+		q = int(round(ext/self.ext_step))
+		key = (model.age,model.Z,q)
+		if key not in self.cache :
+			ext = q*self.ext_step
+			bv, v, weight = model.sample(0.2*min(self.dbv,self.dv))
+			bv = bv + ext
+			v = v + model.R*ext
+			# Rows of the magnitude grid of the data, continued in both directions
+			rows = np.floor((v - self.v_edges[0])/self.dv).astype(int)
+			first = np.min(rows)
+			hist, _, _ = np.histogram2d(rows - first,bv,bins=(np.arange(np.max(rows) - first + 2) - 0.5,self.bv_edges),weights=weight)
+			if self.smooth[0] > 0 or self.smooth[1] > 0 :
+				hist = ndimage.gaussian_filter(hist,self.smooth,mode='constant')
+			self.cache[key] = (hist,first)
+		return self.cache[key]
+
+	def loglike(self,model,dists,ext) :
+		'''
+		Poisson log-likelihood sum(n ln m - m) of the data for the model at
+		every distance modulus of dists and reddening ext. The model is scaled
+		to the number of stars, with a fraction background spread uniformly
+		over the diagram as a floor for field stars and outliers.
+		'''
+		hist, first = self.model_hist(model,ext)
+		shifts = np.round(np.atleast_1d(dists)/self.dv).astype(int)
+		nv = len(self.v_edges) - 1
+		# Rows of the model histogram seen by the data at every shift; the
+		# rows outside the model point to an extra empty row
+		rows = np.arange(nv)[None,:] - shifts[:,None] - first
+		rows[(rows < 0) | (rows >= len(hist))] = len(hist)
+		padded = np.vstack([hist,np.zeros((1,hist.shape[1]))])
+		total = np.sum(np.sum(padded,axis=1)[rows],axis=1)
+		scale = np.where(total > 0,(1.0 - self.background)*self.nstars/np.maximum(total,1e-300),0.0)
+		# The sum of m over the diagram is known from the scaling, so ln m is
+		# only needed in the bins with stars
+		m = padded[rows[:,self.occupied[0]],self.occupied[1]]*scale[:,None] + self.background*self.nstars/self.counts.size
+		msum = np.where(total > 0,1.0,self.background)*self.nstars
+		return np.sum(self.counts[self.occupied]*np.log(m),axis=1) - msum
+
+	def fit(self,models,dists,exts) :
+		'''
+		Grid search of the model (age), distance modulus and reddening with the
+		highest likelihood. Returns the index of the model, the distance, the
+		reddening and the log-likelihood.
+		'''
+		dists = np.atleast_1d(dists)
+		best = (None,None,None,-np.inf)
+		for i, model in enumerate(models) :
+			for ext in exts :
+				lnl = self.loglike(model,dists,ext)
+				j = np.argmax(lnl)
+				if lnl[j] > best[3] :
+					best = (i,round(dists[j]/self.dv)*self.dv,round(ext/self.ext_step)*self.ext_step,lnl[j])
+		return best
+
 # def autofit (cmd,models,modid,dist,ext) : 
 	# '''
 	# Autofit the best choice model around the current preference
@@ -163,7 +322,8 @@ def chisq(cmd,model,dist,ext) :
 				# res.append([models[m].age,d,e,chi2])
 	# return res
 	
-def isofit (cmd=None,models=None) : 
+def isofit (cmd=None,models=None,hess=None,modid=None,dist=10.0,ext=0.1,max_points=20000,decimate=False) : 
+	import matplotlib.pyplot as plt
 	
 	if models is None :
 		print ('loading default model files')
@@ -176,7 +336,7 @@ def isofit (cmd=None,models=None) :
 	
 	#plot the data file
 	#get a fixed fig reference
-	cmd.plot()			# Plot the CMD file
+	cmd.plot(max_points,decimate)			# Plot the CMD file
 	fig = plt.gcf()		# Get the figure for use later
 	ax = plt.gca()		# Get the axes for use later
 
@@ -202,13 +362,14 @@ def isofit (cmd=None,models=None) :
 	stdscr.addstr(6,10,"'o'/'y' to increase/decrease model age")
 	stdscr.addstr(7,10,"'+'/'-' to increase/decrease model distance")
 	stdscr.addstr(8,10,"'9'/'0' to increase/decrease model reddening")
+	if hess is not None : 
+		stdscr.addstr(9,10,"'f' to fit the Hess diagram, 'h' to show its log-likelihood")
 
 	stdscr.refresh()
 	
 	key = ''
-	dist=10.0
-	ext=0.1
-	modid=int(len(models)/2)
+	if modid is None : 
+		modid=int(len(models)/2)
 	
 	age=models[modid].age
 	
@@ -269,7 +430,15 @@ def isofit (cmd=None,models=None) :
 								   + '{:02d}'.format(ltime.tm_sec) \
 								   + ".pdf"
 			stdscr.addstr(12,10,"Saved current figure to " + fname)
-			fig.savefig(fname)
+			with atomic_write(fname) as temporary : 
+				fig.savefig(temporary)
+		elif key == ord('f') and hess is not None : 
+			stdscr.addstr(12,10,"Fitting the Hess diagram...")
+			stdscr.refresh()
+			modid,dist,ext,lnl = hess.fit(models,np.arange(3.0,15.0+0.5*hess.dv,hess.dv),np.arange(0.0,1.5+0.5*hess.ext_step,hess.ext_step))
+			stdscr.addstr(12,10,"Best fit log-likelihood = " + '{:.1f}'.format(lnl) + "              ")
+		elif key == ord('h') and hess is not None : 
+			stdscr.addstr(12,10,"Log-likelihood = " + '{:.1f}'.format(hess.loglike(models[modid],dist,ext)[0]))
 
 		stdscr.addstr(10,10,"                                                           ")
 		stdscr.addstr(10,10,"Age="+models[modid].age+" Distance="+str(dist)+" Extinction="+str(ext))
@@ -298,22 +467,49 @@ def main(argv=None) :
 	if argv is None :
 		argv = sys.argv
 	
-	cmdfile=None
-	modelfile=None
-	
-	print (len(argv), argv)
+	# The data and model files can be given as arguments, options or in a run file
+	settings = config.load("isofit", {
+		"cmdfile" : "CMD.dat",
+		"modelfile" : "PadovaCMD.dat",
+		# Hess diagram (binned CMD) likelihood: bin sizes in B-V and V, fraction
+		# of field stars, and whether to start from the best fit
+		"colour_bin" : 0.05,
+		"mag_bin" : 0.1,
+		"background" : 0.05,
+		"hess_fit" : False,
+		# Lowest membership probability of the stars, for files with a pmem column
+		"pmin" : 0.0,
+		# CMDs with more stars are drawn as a density image, or as a random
+		# subset of max_points stars with decimate
+		"max_points" : 20000,
+		"decimate" : False,
+	}, "Interactive isochrone fitting", argv[1:], positional=["cmdfile","modelfile"])
 
-	if(len(argv)>1) : 
-		cmdfile=argv[1]
-	if(len(argv)>2) : 
-		modelfile=argv[2]
+	cmd = loaddata(settings.cmdfile,settings.pmin)
+	if cmd is None or len(cmd.v) == 0 : 
+		print ("ERROR: no stars loaded from " + settings.cmdfile)
+		sys.exit()
+	models = loadmodels(settings.modelfile)
+	if models is None or len(models) == 0 : 
+		print ("ERROR: no model CMDs loaded from " + settings.modelfile)
+		sys.exit()
 
-	cmd = loaddata(cmdfile)
-	models = loadmodels(modelfile)
-	
-	isofit(cmd,models)
+	# matplotlib is only imported once the settings and the files are checked,
+	# so that --help and the errors answer at once
+	import matplotlib
+	matplotlib.use('GTK3Agg')	# Added to force use of X display for forwarding ; FC 2020/04/28
+	hess = HessDiagram(cmd,binsize=(settings.colour_bin,settings.mag_bin),background=settings.background)
+	
+	if settings.hess_fit : 
+		modid,dist,ext,lnl = hess.fit(models,np.arange(3.0,15.0+0.5*hess.dv,hess.dv),np.arange(0.0,1.5+0.5*hess.ext_step,hess.ext_step))
+		print ("Best fit: age=10^" + models[modid].age + "yr distance=" + '{:.1f}'.format(dist) + "mag E(B-V)=" + '{:.3f}'.format(ext) + " log-likelihood=" + '{:.1f}'.format(lnl))
+		isofit(cmd,models,hess,modid,dist,ext,settings.max_points,settings.decimate)
+	else : 
+		isofit(cmd,models,hess,max_points=settings.max_points,decimate=settings.decimate)
 	
 	return
 
 if __name__ == "__main__" : 
 	main()
+
+
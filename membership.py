@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+
+# © 2020 University of Oxford - Department of Physics
+# Physics Practical Course AS35 - Colour-magnitude diagrams of open clusters
+# Field star decontamination
+
+# Import Python Libraries
+import os
+import sys
+import config
+
+# EDIT the settings in a run file (--config run.toml) or on the command line
+settings = config.load("membership", {
+	# Name of the cluster, its centre (degrees, the median position of the stars if not given)
+	"target": "NGC0663",
+	"ra": None,
+	"dec": None,
+	# Radius (arcmin) of the cluster region
+	"cluster_radius": 5.0,
+	# Field region: an annulus around the cluster (arcmin), or a circle of
+	# field_radius around field_ra, field_dec if they are given
+	"field_inner": 8.0,
+	"field_outer": 12.0,
+	"field_ra": None,
+	"field_dec": None,
+	"field_radius": 5.0,
+	# Size of the CMD neighbourhood in B-V and V (mag)
+	"colour_scale": 0.1,
+	"mag_scale": 0.3,
+	# Filters of the combined images whose footprint limits the regions, and
+	# the step (pixels) of the grid of pixels used to measure their areas
+	"filters": ["B", "V"],
+	"area_step": 4,
+}, "Membership probabilities of the stars of mag_<target>.txt")
+target = settings.target
+
+import numpy as np
+from scipy.spatial import cKDTree
+from astropy.io import fits
+from astropy import wcs
+import astropy.wcs.utils
+from checkpoint import atomic_write
+
+
+def separation(ra, dec, ra0, dec0):
+	'''
+	Angular distance (arcmin) of the stars from (ra0, dec0), all in degrees.
+	'''
+	ra = np.radians(ra)
+	dec = np.radians(dec)
+	ra0 = np.radians(ra0)
+	dec0 = np.radians(dec0)
+	# Haversine formula, accurate at small separations
+	a = np.sin(0.5*(dec - dec0))**2 + np.cos(dec)*np.cos(dec0)*np.sin(0.5*(ra - ra0))**2
+	return np.degrees(2*np.arcsin(np.sqrt(np.clip(a, 0, 1))))*60.
+
+
+def read_footprint(filename):
+	'''
+	Pixels with data of a combined image, and its WCS.
+	'''
+	with fits.open(filename) as hdulist:
+		footprint = np.isfinite(hdulist[0].data)
+		if "WEIGHT" in hdulist:
+			footprint &= hdulist["WEIGHT"].data > 0
+		return footprint, wcs.WCS(hdulist[0].header)
+
+
+def covered_area(inside, footprints, step=4):
+	'''
+	Area (arcmin^2) of a region within the footprint of all the images: the
+	pixels of the first image, sampled every step pixels, with data in every
+	image and whose sky position is inside the region.
+	inside(ra, dec) tells which positions are inside the region, and
+	footprints lists the pixels with data and the WCS of every image.
+	'''
+	footprint, w = footprints[0]
+	ny, nx = footprint.shape
+	y, x = np.mgrid[step//2:ny:step, step//2:nx:step]
+	covered = footprint[y, x]
+	ra, dec = w.all_pix2world(x[covered], y[covered], 0)
+	covered = inside(ra, dec)
+	for other, other_wcs in footprints[1:]:
+		xo, yo = other_wcs.all_world2pix(ra, dec, 0)
+		xo = np.round(xo).astype(int)
+		yo = np.round(yo).astype(int)
+		on_image = (xo >= 0) & (xo < other.shape[1]) & (yo >= 0) & (yo < other.shape[0])
+		covered[on_image] &= other[yo[on_image], xo[on_image]]
+		covered &= on_image
+	pixel_area = np.prod(wcs.utils.proj_plane_pixel_scales(w))*3600.
+	return np.count_nonzero(covered)*pixel_area*step**2
+
+
+def cmd_density(points, reference, scale):
+	'''
+	Number of the reference stars within one scale of the CMD positions
+	points, counted for all the positions at once with a KD-tree.
+	'''
+	tree = cKDTree(reference/scale)
+	return tree.query_ball_point(points/scale, r=1.0, return_length=True, workers=-1)
+
+
+def membership(colour, mag, cluster, field, area_cluster, area_field, scale=(0.1, 0.3)):
+	'''
+	Probability that the stars of the cluster region are members, comparing
+	the CMD density of the cluster region with that of the field region scaled
+	to the same area: P = 1 - n_field*A_cluster/(A_field*n_cluster).
+	The stars outside the cluster region have P = 0.
+	'''
+	points = np.array([colour, mag]).T
+	finite = np.all(np.isfinite(points), axis=1)
+	cluster = cluster & finite
+	scale = np.array(scale)
+	# Only the stars of the cluster region need their densities
+	n_cluster = cmd_density(points[cluster], points[cluster], scale)
+	n_field = cmd_density(points[cluster], points[field & finite], scale)
+	pmem = np.zeros(len(points))
+	pmem[cluster] = np.clip(1. - n_field*area_cluster/(area_field*n_cluster), 0., 1.)
+	return pmem
+
+
+if __name__ == "__main__":
+	mag_file = "mag_" + target + ".txt"
+	if os.path.isfile(mag_file) != True:
+		print ("ERROR: " + mag_file + " does not exist")
+		sys.exit()
+
+	# Load the magnitudes of the stars
+	stars = np.atleast_2d(np.loadtxt(mag_file))
+	ra = stars[:,0]
+	dec = stars[:,1]
+	mag_b = stars[:,2]
+	mag_v = stars[:,3]
+
+	ra0 = np.median(ra) if settings.ra is None else settings.ra
+	dec0 = np.median(dec) if settings.dec is None else settings.dec
+
+	# Footprint of the combined images, which limits the areas of the regions
+	footprints = []
+	for filter_name in settings.filters:
+		filename = target + "_combined/" + target + "_" + filter_name + "_combined.fits"
+		if os.path.isfile(filename) != True:
+			print ("ERROR: " + filename + " does not exist")
+			sys.exit()
+		footprints.append(read_footprint(filename))
+
+	# Select the cluster and field regions
+	def in_cluster(ra, dec):
+		return separation(ra, dec, ra0, dec0) <= settings.cluster_radius
+
+	def in_field(ra, dec):
+		if settings.field_ra is None or settings.field_dec is None:
+			distance = separation(ra, dec, ra0, dec0)
+			field = (distance >= settings.field_inner) & (distance <= settings.field_outer)
+		else:
+			field = separation(ra, dec, settings.field_ra, settings.field_dec) <= settings.field_radius
+		return field & ~in_cluster(ra, dec)
+
+	cluster = in_cluster(ra, dec)
+	field = in_field(ra, dec)
+	area_cluster = covered_area(in_cluster, footprints, settings.area_step)
+	area_field = covered_area(in_field, footprints, settings.area_step)
+	if np.count_nonzero(cluster) == 0 or np.count_nonzero(field) == 0 or area_field == 0:
+		print ("ERROR: no stars found in the cluster or the field region")
+		sys.exit()
+	print ("Cluster region: " + str(np.count_nonzero(cluster)) + " stars in {:.1f} arcmin^2".format(area_cluster))
+	print ("Field region: " + str(np.count_nonzero(field)) + " stars in {:.1f} arcmin^2".format(area_field))
+
+	pmem = membership(mag_b - mag_v, mag_v, cluster, field, area_cluster, area_field, (settings.colour_scale, settings.mag_scale))
+	print ("Expected number of members: {:.0f}".format(np.sum(pmem)))
+
+	# Save the magnitudes with the membership probabilities
+	data = np.column_stack([stars, pmem])
+	fmt = ['%le','%le','%7.3f','%7.3f','%6.3f','%6.3f'][:stars.shape[1]] + ['%5.3f']
+	header = "RA Dec magB magV magB_err magV_err".split()[:stars.shape[1]] + ["pmem"]
+	with atomic_write("mem_" + target + ".txt") as temporary:
+		np.savetxt(temporary, data, fmt=fmt, header=" ".join(header))
+	print ("Membership probabilities saved in mem_" + target + ".txt")
@@ -7,27 +7,55 @@
 # Import Python Libraries
 import glob, os
 import sys
-from astropy.stats import sigma_clipped_stats
+import config
+
+# EDIT the settings in a run file (--config run.toml) or on the command line
+settings = config.load("photometry", {
+	# Name of the cluster, the file the positions of the stars, the zeropoints and the aperture radius
+	"target": "NGC0663",
+	"stars_file": "stars_NGC0663_B.txt",
+	"zeropoint_b": 19.51,
+	"zeropoint_v": 19.75,
+	"aperture_radius": 7.2,
+	# Inner and outer radii of the annulus for the local background
+	"annulus": (6.0, 12.0),
+	# Photometry method: "aperture", or "psf" for crowded fields
+	"method": "aperture",
+	"psf_size": 25,
+	"psf_fit_radius": 6.0,
+	# Calibration: "zeropoint" uses the zeropoints above, "catalogue" solves for
+	# the zeropoints and colour terms with the stars of a reference catalogue
+	# (columns RA Dec B V [B_err V_err]) within match_radius arcsec
+	"calibration": "zeropoint",
+	"ref_catalogue": "standards_NGC0663.txt",
+	"match_radius": 2.0,
+	# Extinction coefficients (mag/airmass), applied at the airmass of the
+	# combined images
+	"extinction_b": 0.25,
+	"extinction_v": 0.15,
+}, "Measure the B and V magnitudes of the stars into mag_<target>.txt")
+target = settings.target
+stars_file = settings.stars_file
+zeropoint_b = settings.zeropoint_b
+zeropoint_v = settings.zeropoint_v
+aperture_radius = settings.aperture_radius
+method = settings.method
+psf_size = settings.psf_size
+psf_fit_radius = settings.psf_fit_radius
+calibration = settings.calibration
+
 from astropy.io import fits
-from photutils import DAOStarFinder
-from photutils import CircularAperture, CircularAnnulus
-from photutils import aperture_photometry
 from astropy import wcs
 import numpy as np
+from psf_photometry import select_psf_stars, build_epsf, psf_photometry
+import calibrate
+from checkpoint import atomic_write, write_json
 import warnings
 from astropy.utils.exceptions import AstropyWarning
 warnings.simplefilter('ignore', category=AstropyWarning)
 warnings.filterwarnings('ignore')
 
 
-
-# EDIT the name of the cluster, the file the positions of the stars, the zeropoints and the aperture radius
-target = "NGC0663"
-stars_file = "stars_NGC0663_B.txt"
-zeropoint_b = 19.51
-zeropoint_v = 19.75
-aperture_radius = 7.2
-
 def do_photometry(target, filter_name, stars):
 	filename = target + "_combined/" + target + "_" + filter_name + "_combined.fits"
 	
@@ -39,6 +67,11 @@ def do_photometry(target, filter_name, stars):
 	hdulist = fits.open(filename)
 	data = hdulist[0].data
 	header = hdulist[0].header
+	airmass = header.get("AIRMASS", 1.0)
+	# and the variance plane written by combine_sci.py, if any
+	variance = None
+	if "UNCERT" in hdulist and hdulist["UNCERT"].header.get("UTYPE", "") == "VarianceUncertainty":
+		variance = hdulist["UNCERT"].data
 	hdulist.close()
 	
 	# Convert from sky coordinates to pixel
@@ -46,46 +79,108 @@ def do_photometry(target, filter_name, stars):
 	xpix,ypix = w.all_world2pix(stars, 0).T
 	pixel_coordinates = list(zip(xpix,ypix))
 
+	if method == "psf":
+		fluxes, errors = do_psf_photometry(data, variance, xpix, ypix)
+	else:
+		fluxes, errors = do_aperture_photometry(data, variance, pixel_coordinates)
+
+	# Ignore the fluxes of stars too close the image borders
+	mask_size = 15
+	mask = (xpix < mask_size) | (xpix > data.shape[1] - mask_size) | (ypix < mask_size) | (ypix > data.shape[0] - mask_size)
+	fluxes[mask] = np.nan
+	errors[mask] = np.nan
+
+	return fluxes, errors, airmass
+
+def do_aperture_photometry(data, variance, pixel_coordinates):
+	# photutils is slow to import, and only needed for aperture photometry
+	from photutils import CircularAperture, CircularAnnulus
+	from photutils import aperture_photometry
+
 	# Generate the annulus aperture for the local background
-	annulus_apertures = CircularAnnulus(pixel_coordinates, r_in=6., r_out=12.)
+	annulus_apertures = CircularAnnulus(pixel_coordinates, r_in=settings.annulus[0], r_out=settings.annulus[1])
 	annulus_mask = annulus_apertures.to_mask()
 	# and calculate the background level per pixel
 	background_median = np.zeros(len(annulus_mask))
+	background_std = np.zeros(len(annulus_mask))
+	background_npix = np.zeros(len(annulus_mask))
 	for i, mask in enumerate(annulus_mask):
 		data_cutout_aper = mask.cutout(data)
-		background_median[i] = np.nanmedian(data_cutout_aper[data_cutout_aper != 0])
+		values = data_cutout_aper[data_cutout_aper != 0]
+		background_median[i] = np.nanmedian(values)
+		background_std[i] = np.nanstd(values)
+		background_npix[i] = np.count_nonzero(np.isfinite(values))
 
 	# Generate the circular apertures
 	apertures = CircularAperture(pixel_coordinates, r=aperture_radius)
 	# and do the photometry
-	fluxes = aperture_photometry(data, apertures)
-	
-	# Ignore the fluxes of stars too close the image borders
-	mask_size = 15
-	mask = (xpix < mask_size) | (xpix > data.shape[1] - mask_size) | (ypix < mask_size) | (ypix > data.shape[0] - mask_size)
-	fluxes["aperture_sum"][mask] = np.nan
-	
-	# Return the background subtracted fluxes
-	return fluxes["aperture_sum"] - background_median*apertures.area
+	if variance is not None:
+		fluxes = aperture_photometry(data, apertures, error=np.sqrt(variance))
+		source_variance = np.array(fluxes["aperture_sum_err"])**2
+	else:
+		# Without a variance plane use the scatter in the annulus for each pixel
+		fluxes = aperture_photometry(data, apertures)
+		source_variance = apertures.area*background_std**2
 
+	# Error of the background median, scaled to the aperture area
+	background_variance = (apertures.area*background_std)**2*0.5*np.pi/background_npix
 
-if os.path.isfile(stars_file) != True:
-	print ("ERROR: " + stars_file + " does not exist")
-	sys.exit()
-	
-# Load the location of the stars
-stars = np.loadtxt(stars_file)
-
-# Measure the fluxes in counts/s in the B and V images
-flux_b = do_photometry(target, "B", stars)
-flux_v = do_photometry(target, "V", stars)
-
-# Convert from fluxes to magnitudes using the provided zeropoint
-mag_b = zeropoint_b -2.5*np.log10(flux_b)
-mag_v = zeropoint_v -2.5*np.log10(flux_v)
-
-# Save the positions and fluxes
-mask = ((np.isfinite(mag_b) & np.isfinite(mag_v)))
-data = np.array([stars[mask,0], stars[mask,1], mag_b[mask], mag_v[mask]]).T
-np.savetxt("mag_" + target + ".txt", data, fmt=['%le','%le','%7.3f','%7.3f'], header="RA Dec magB magV")
-print ("Magnitudes saved in mag_" + target + ".txt")
+	# Return the background subtracted fluxes and their errors
+	return np.array(fluxes["aperture_sum"] - background_median*apertures.area), np.sqrt(source_variance + background_variance)
+
+def do_psf_photometry(data, variance, xpix, ypix):
+	# Build the empirical PSF from bright isolated stars
+	psf_stars = select_psf_stars(data, xpix, ypix, size=psf_size)
+	psf = build_epsf(data, xpix[psf_stars], ypix[psf_stars], size=psf_size, norm_radius=aperture_radius)
+	if psf is None:
+		print ("ERROR: no isolated stars found to build the PSF")
+		sys.exit()
+	print ("PSF built from " + str(len(psf_stars)) + " stars")
+
+	# Fit blended stars simultaneously; the PSF is normalised within the
+	# aperture radius, so the fluxes use the same zeropoints
+	return psf_photometry(data, xpix, ypix, psf, variance=variance, fit_radius=psf_fit_radius)
+
+
+# Worker processes may import this script, so only the main process measures
+if __name__ == "__main__":
+	if os.path.isfile(stars_file) != True:
+		print ("ERROR: " + stars_file + " does not exist")
+		sys.exit()
+	if calibration == "catalogue" and os.path.isfile(settings.ref_catalogue) != True:
+		print ("ERROR: " + settings.ref_catalogue + " does not exist")
+		sys.exit()
+
+	# Load the location of the stars
+	stars = np.loadtxt(stars_file)
+
+	# Measure the fluxes in counts/s in the B and V images
+	flux_b, flux_b_err, airmass_b = do_photometry(target, "B", stars)
+	flux_v, flux_v_err, airmass_v = do_photometry(target, "V", stars)
+
+	# Convert the flux errors to magnitude errors
+	mag_b_err = 2.5/np.log(10.)*flux_b_err/flux_b
+	mag_v_err = 2.5/np.log(10.)*flux_v_err/flux_v
+
+	if calibration == "catalogue":
+		# Solve for the calibration with the stars of the reference catalogue
+		catalogue = calibrate.read_catalogue(settings.ref_catalogue)
+		mag_b, mag_v, solution_b, solution_v = calibrate.calibrate(stars[:,0], stars[:,1], -2.5*np.log10(flux_b), -2.5*np.log10(flux_v), airmass_b, airmass_v, catalogue, mag_b_err, mag_v_err, settings.match_radius, settings.extinction_b, settings.extinction_v)
+		if mag_b is None:
+			print ("ERROR: not enough stars matched in " + settings.ref_catalogue)
+			sys.exit()
+		for filter_name, solution in [("B", solution_b), ("V", solution_v)]:
+			print ("{}: zeropoint = {:.3f} +- {:.3f}, colour term = {:.3f} +- {:.3f}, extinction = {:.3f}, rms = {:.3f} ({} stars)".format(filter_name, solution["zeropoint"], solution["zeropoint_err"], solution["colour_term"], solution["colour_term_err"], solution["extinction"], solution["rms"], solution["nstars"]))
+		write_json({"catalogue": settings.ref_catalogue, "airmass": {"B": airmass_b, "V": airmass_v}, "B": solution_b, "V": solution_v}, "calib_" + target + ".json")
+		print ("Calibration saved in calib_" + target + ".json")
+	else:
+		# Convert from fluxes to magnitudes using the provided zeropoint
+		mag_b = zeropoint_b -2.5*np.log10(flux_b)
+		mag_v = zeropoint_v -2.5*np.log10(flux_v)
+
+	# Save the positions and fluxes
+	mask = ((np.isfinite(mag_b) & np.isfinite(mag_v)))
+	data = np.array([stars[mask,0], stars[mask,1], mag_b[mask], mag_v[mask], mag_b_err[mask], mag_v_err[mask]]).T
+	with atomic_write("mag_" + target + ".txt") as temporary:
+		np.savetxt(temporary, data, fmt=['%le','%le','%7.3f','%7.3f','%6.3f','%6.3f'], header="RA Dec magB magV magB_err magV_err")
+	print ("Magnitudes saved in mag_" + target + ".txt")
@@ -5,33 +5,189 @@
 # Bias Plotter
 
 # Import Python Libraries
+import os
+import sys
+import config
+
+# EDIT the settings in a run file (--config run.toml) or on the command line
+settings = config.load("plot_bias", {
+	"list_file": "bias_files.txt",
+	"output_file": "bias_stats.fits",
+	# Order of the polynomials fitted along the rows and the columns
+	"model_order": 3,
+	"plot": True,
+}, "Statistics, structure model and plots of the bias frames")
+list_file = settings.list_file
+output_file = settings.output_file
+model_order = settings.model_order
+
 import ccdproc
 from ccdproc import CCDData
 from astropy import units as u
+from astropy.io import fits
+from astropy.table import Table
 import numpy as np
-import matplotlib.pyplot as plt
+from checkpoint import atomic_write, write_fits
 
-# Reads the bias file
-filename = "Calibration/Bias-S008-R002-C001-B2.fts"
-ccd = CCDData.read(filename, unit = u.adu)
+# Check that the bias_files exists
+if os.path.isfile(list_file) != True:
+	print ("ERROR: " + list_file + " does not exist")
+	sys.exit()
 
-# Calculates the mean value averaging along the y and x axis
-bias_x = np.mean(ccd.data, axis=0)
-bias_y = np.mean(ccd.data, axis=1)
+def parse_section(section):
+	# Convert a FITS section '[x1:x2,y1:y2]' into numpy slices
+	xrange, yrange = section.strip().strip("[]").split(",")
+	x1, x2 = [int(v) for v in xrange.split(":")]
+	y1, y2 = [int(v) for v in yrange.split(":")]
+	return slice(y1-1, y2), slice(x1-1, x2)
 
-# Save the results as text ascii files
-np.savetxt("bias_x.txt", bias_x)
-np.savetxt("bias_y.txt", bias_y)
+def fit_profile(profile, order):
+	# Fit a Legendre polynomial to a profile, ignoring outlying pixels
+	x = np.linspace(-1., 1., len(profile))
+	good = np.isfinite(profile)
+	for iteration in range(3):
+		coeffs = np.polynomial.legendre.legfit(x[good], profile[good], order)
+		residuals = profile - np.polynomial.legendre.legval(x, coeffs)
+		std = 1.4826*np.nanmedian(np.abs(residuals[good]))
+		good = np.isfinite(profile) & (np.abs(residuals) < 5*std + 1e-12)
+	return coeffs, np.polynomial.legendre.legval(x, coeffs)
 
-# and as figures
-plt.close()
-plt.xlabel('x pixel')
-plt.ylabel('value')
-plt.scatter(np.arange(len(bias_x)), bias_x)
-plt.savefig("bias_x.png")
+# Read the bias files one at a time, keeping only running sums and the mean
+# row and column profiles of each frame, which are saved in ROWPROF and
+# COLPROF: memory grows by two profiles per frame, not by a full frame
+filenames = []
+frame_mean = []
+frame_std = []
+frame_overscan = []
+col_means = []
+row_means = []
+shift = None
+for bias in open(list_file, "r"):
+	bias = bias.strip()
+	if len(bias) == 0 or bias[0] == "#":
+		continue
+
+	if os.path.isfile(bias) != True:
+		print ("ERROR: The " + bias + " file listed in " + list_file + " does not exist")
+		sys.exit()
+
+	# Read the frame
+	ccd = CCDData.read(bias, unit = u.adu)
+
+	# Check that it is a bias frame
+	if ccd.header["IMAGETYP"] != "Bias Frame":
+		print ("ERROR: The " + bias + " file does not seem to be a bias file")
+		sys.exit()
+
+	data = np.asarray(ccd.data, dtype=np.float64)
+
+	# Level of the overscan region, if the detector has one
+	overscan = np.nan
+	if "BIASSEC" in ccd.header:
+		overscan = np.median(data[parse_section(ccd.header["BIASSEC"])])
+
+	# Sums are accumulated around the level of the first frame to keep precision
+	if shift is None:
+		shift = np.median(data)
+		col_sum = np.zeros(data.shape[1])
+		col_sumsq = np.zeros(data.shape[1])
+		row_sum = np.zeros(data.shape[0])
+		row_sumsq = np.zeros(data.shape[0])
+	elif data.shape != (len(row_sum), len(col_sum)):
+		print ("ERROR: The " + bias + " file does not have the same size as the previous bias files")
+		sys.exit()
+	data -= shift
+
+	col_sum += np.sum(data, axis=0)
+	col_sumsq += np.sum(data**2, axis=0)
+	row_sum += np.sum(data, axis=1)
+	row_sumsq += np.sum(data**2, axis=1)
+
+	col_means.append((np.mean(data, axis=0) + shift).astype(np.float32))
+	row_means.append((np.mean(data, axis=1) + shift).astype(np.float32))
+
+	filenames.append(bias)
+	frame_mean.append(np.mean(data) + shift)
+	frame_std.append(np.std(data))
+	frame_overscan.append(overscan)
+
+# Check that there is at least 1 bias to be analysed
+if len(filenames) == 0:
+	print ("ERROR: " + list_file + " does not contain any valid file")
+	sys.exit()
+
+nframes = len(filenames)
+col_means = np.array(col_means, dtype=np.float32)
+row_means = np.array(row_means, dtype=np.float32)
+
+# Statistics per column (x) and per row (y) over all the frames. The pixel
+# median would need the whole stack, so the robust profile is the median
+# over the frames of their mean profiles, which ignores the deviant frames
+nrows = len(row_sum)
+ncols = len(col_sum)
+bias_x = col_sum/(nrows*nframes) + shift
+std_x = np.sqrt(np.maximum(col_sumsq/(nrows*nframes) - (bias_x - shift)**2, 0.))
+median_x = np.median(col_means, axis=0)
+bias_y = row_sum/(ncols*nframes) + shift
+std_y = np.sqrt(np.maximum(row_sumsq/(ncols*nframes) - (bias_y - shift)**2, 0.))
+median_y = np.median(row_means, axis=0)
+
+# Model the bias structure as a smooth polynomial along each axis, plus the
+# fixed column pattern left over along the rows
+coeffs_x, model_x = fit_profile(median_x, model_order)
+coeffs_y, model_y = fit_profile(median_y, model_order)
+column_pattern = median_x - model_x
+
+# Save the results in a single FITS file
+header = fits.Header()
+header["NFRAMES"] = (nframes, "Number of bias frames")
+header["MORDER"] = (model_order, "Order of the Legendre polynomials")
+for i, c in enumerate(coeffs_x):
+	header["XCOEF" + str(i)] = (c, "Legendre coefficient along x")
+for i, c in enumerate(coeffs_y):
+	header["YCOEF" + str(i)] = (c, "Legendre coefficient along y")
+header["COLRMS"] = (np.nanstd(column_pattern), "RMS of the column pattern")
+
+columns = Table([np.arange(ncols), bias_x, median_x, std_x, model_x, column_pattern], names=["x", "mean", "median_of_means", "std", "model", "pattern"])
+rows = Table([np.arange(nrows), bias_y, median_y, std_y, model_y], names=["y", "mean", "median_of_means", "std", "model"])
+frames = Table([filenames, frame_mean, frame_std, frame_overscan], names=["file", "mean", "std", "overscan"])
+
+hdulist = fits.HDUList([fits.PrimaryHDU(header=header)])
+for table, name in [(columns, "COLUMNS"), (rows, "ROWS"), (frames, "FRAMES")]:
+	hdu = fits.table_to_hdu(table)
+	hdu.name = name
+	hdulist.append(hdu)
+# and the per-frame profiles, to follow the stability of the bias
+hdulist.append(fits.ImageHDU(col_means, name="COLPROF"))
+hdulist.append(fits.ImageHDU(row_means, name="ROWPROF"))
+write_fits(hdulist, output_file)
+print ("Bias statistics of " + str(nframes) + " frames saved in " + output_file)
+
+if not settings.plot:
+	sys.exit()
+
+# and as figures, with rasterized lines to keep them small for large detectors
+import matplotlib.pyplot as plt
+
+def plot_profile(pixel, mean, median, std, model, label, filename):
+	plt.close()
+	plt.xlabel(label + ' pixel')
+	plt.ylabel('value')
+	plt.fill_between(pixel, mean - std, mean + std, color='0.8', lw=0, rasterized=True, label='std')
+	plt.plot(pixel, mean, lw=0.5, rasterized=True, label='mean')
+	plt.plot(pixel, median, lw=0.5, rasterized=True, label='median of the frame means')
+	plt.plot(pixel, model, lw=1.5, label='model')
+	plt.legend(loc='best')
+	with atomic_write(filename) as temporary:
+		plt.savefig(temporary)
+
+plot_profile(np.arange(ncols), bias_x, median_x, std_x, model_x, 'x', "bias_x.png")
+plot_profile(np.arange(nrows), bias_y, median_y, std_y, model_y, 'y', "bias_y.png")
 
 plt.close()
-plt.xlabel('y pixel')
-plt.ylabel('value')
-plt.scatter(np.arange(len(bias_y)), bias_y)
-plt.savefig("bias_y.png")
\ No newline at end of file
+plt.xlabel('frame')
+plt.ylabel('mean value')
+plt.errorbar(np.arange(nframes), frame_mean, yerr=frame_std, fmt='.', rasterized=True)
+with atomic_write("bias_frames.png") as temporary:
+	plt.savefig(temporary)
+print ("Plots saved in bias_x.png, bias_y.png and bias_frames.png")
@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+
+# © 2020 University of Oxford - Department of Physics
+# Physics Practical Course AS35 - Colour-magnitude diagrams of open clusters
+# PSF Photometry for crowded fields
+
+# Import Python Libraries
+import os
+import numpy as np
+from scipy import ndimage
+from scipy.spatial import cKDTree
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from concurrent.futures import ProcessPoolExecutor
+
+
+def select_psf_stars(data, xpix, ypix, size=25, nstars=50, min_stars=10, min_radius=None):
+	'''
+	Select bright, isolated and unsaturated stars to build the PSF from.
+	A star is isolated if it has no neighbour within size pixels; in crowded
+	fields the radius is reduced progressively, down to min_radius (size/4 by
+	default), until at least min_stars stars qualify.
+	Returns the indices of the selected stars.
+	'''
+	half = size//2 + 2
+	ny, nx = data.shape
+	xpix = np.asarray(xpix)
+	ypix = np.asarray(ypix)
+	finite = np.isfinite(xpix) & np.isfinite(ypix)
+	if min_radius is None:
+		min_radius = 0.25*size
+
+	# Stars far enough from the borders to extract a full cutout
+	inside = finite & (xpix > half) & (xpix < nx - half - 1) & (ypix > half) & (ypix < ny - half - 1)
+
+	# Peak pixel value of the stars; saturated pixels are NaN and drop out
+	peak = np.full(len(xpix), np.nan)
+	xi = np.round(xpix[inside]).astype(int)
+	yi = np.round(ypix[inside]).astype(int)
+	peak[inside] = data[yi, xi]
+	usable = inside & np.isfinite(peak) & (peak > 0)
+
+	# Distance to the nearest neighbour of each star
+	tree = cKDTree(np.array([xpix[finite], ypix[finite]]).T)
+	nearest = np.full(len(xpix), np.inf)
+	if np.count_nonzero(finite) > 1:
+		nearest[finite] = tree.query(tree.data, k=2)[0][:,1]
+
+	# Relax the isolation radius until enough stars qualify
+	radius = float(size)
+	while True:
+		candidates = np.nonzero(usable & (nearest > radius))[0]
+		if len(candidates) >= min_stars or radius <= min_radius:
+			break
+		radius = max(0.8*radius, min_radius)
+
+	# Rank by the peak pixel value
+	return candidates[np.argsort(peak[candidates])[::-1][:nstars]]
+
+
+def build_epsf(data, xpix, ypix, size=25, norm_radius=None):
+	'''
+	Build an empirical PSF by stacking sub-pixel aligned cutouts of the given stars.
+	The PSF is normalised to unit flux within norm_radius (or the whole cutout),
+	so PSF fluxes are on the same scale as aperture fluxes of that radius.
+	'''
+	half = size//2
+	pad = half + 2
+	stamps = []
+	for x, y in zip(xpix, ypix):
+		xi = int(np.round(x))
+		yi = int(np.round(y))
+		cutout = np.array(data[yi-pad:yi+pad+1, xi-pad:xi+pad+1], dtype=np.float64)
+		if cutout.shape != (2*pad+1, 2*pad+1) or not np.all(np.isfinite(cutout)):
+			continue
+
+		# Subtract the local background measured on the cutout edges
+		edge = np.concatenate([cutout[0], cutout[-1], cutout[1:-1,0], cutout[1:-1,-1]])
+		cutout = cutout - np.median(edge)
+
+		# Recentre the star on the central pixel
+		cutout = ndimage.shift(cutout, (yi - y, xi - x), order=3, mode='nearest')
+		cutout = cutout[2:-2, 2:-2]
+		total = np.sum(cutout)
+		if total <= 0:
+			continue
+		stamps.append(cutout/total)
+
+	if len(stamps) == 0:
+		return None
+
+	psf = np.median(np.array(stamps), axis=0)
+
+	# Remove any residual offset of the stacked profile
+	cy, cx = ndimage.center_of_mass(np.clip(psf, 0, None))
+	psf = ndimage.shift(psf, (half - cy, half - cx), order=3, mode='constant')
+
+	# Normalise the PSF
+	if norm_radius is None:
+		psf = psf/np.sum(psf)
+	else:
+		yy, xx = np.mgrid[-half:half+1, -half:half+1]
+		psf = psf/np.sum(psf[xx**2 + yy**2 <= norm_radius**2])
+
+	return psf
+
+
+def group_stars(xpix, ypix, crit_separation):
+	'''
+	Group stars closer than crit_separation, so that blended stars are fitted together.
+	Returns a list of index arrays, one per group.
+	'''
+	n = len(xpix)
+	tree = cKDTree(np.array([xpix, ypix]).T)
+	pairs = tree.query_pairs(r=crit_separation, output_type='ndarray')
+	graph = coo_matrix((np.ones(len(pairs)), (pairs[:,0], pairs[:,1])), shape=(n, n))
+	ngroups, labels = connected_components(graph, directed=False)
+
+	order = np.argsort(labels, kind='stable')
+	bounds = np.cumsum(np.bincount(labels, minlength=ngroups))[:-1]
+	return np.split(order, bounds)
+
+
+def _sample(image, yy, xx):
+	# Evaluate an image centred on its central pixel at offsets (yy, xx)
+	half = image.shape[0]//2
+	return ndimage.map_coordinates(image, [yy + half, xx + half], order=3, mode='constant', cval=0.)
+
+
+def fit_group(cutout, variance, x0, y0, psf, psf_dx, psf_dy, fit_radius, recenter=2):
+	'''
+	Simultaneously fit the fluxes (and optionally positions) of a group of stars
+	with a constant local background. Positions are relative to the cutout.
+	Pixels are weighted by the inverse variance when a variance cutout is given.
+	Returns the fluxes, their errors, and the fitted x and y positions.
+	'''
+	nstars = len(x0)
+	x = np.array(x0, dtype=np.float64)
+	y = np.array(y0, dtype=np.float64)
+	flux = np.full(nstars, np.nan)
+	flux_err = np.full(nstars, np.nan)
+
+	# Use only the finite pixels within fit_radius of any star
+	yy, xx = np.mgrid[0:cutout.shape[0], 0:cutout.shape[1]]
+	yy = yy.ravel().astype(np.float64)
+	xx = xx.ravel().astype(np.float64)
+	values = cutout.ravel()
+	near = np.zeros(len(values), dtype=bool)
+	for xs, ys in zip(x, y):
+		near |= ((xx - xs)**2 + (yy - ys)**2 <= fit_radius**2)
+	good = near & np.isfinite(values)
+	if variance is not None:
+		variance = variance.ravel()
+		good &= np.isfinite(variance) & (variance > 0)
+	if np.count_nonzero(good) <= nstars + 1:
+		return flux, flux_err, x, y
+	yy = yy[good]
+	xx = xx[good]
+	values = values[good]
+	if variance is not None:
+		weights = 1./np.sqrt(variance[good])
+	else:
+		weights = np.ones(len(values))
+
+	for iteration in range(recenter + 1):
+		dy = yy[None,:] - y[:,None]
+		dx = xx[None,:] - x[:,None]
+		model = _sample(psf, dy.ravel(), dx.ravel()).reshape(nstars, -1)
+
+		if iteration < recenter:
+			# Linearised fit for flux and flux*shift of each star
+			gx = _sample(psf_dx, dy.ravel(), dx.ravel()).reshape(nstars, -1)
+			gy = _sample(psf_dy, dy.ravel(), dx.ravel()).reshape(nstars, -1)
+			design = np.vstack([model, -gx, -gy, np.ones((1, len(values)))]).T
+		else:
+			design = np.vstack([model, np.ones((1, len(values)))]).T
+
+		coeffs, _, _, _ = np.linalg.lstsq(design*weights[:,None], values*weights, rcond=None)
+		flux = coeffs[:nstars]
+
+		if iteration < recenter:
+			# Update the positions, limiting the shifts to one pixel per iteration
+			with np.errstate(divide='ignore', invalid='ignore'):
+				shift_x = np.where(flux > 0, coeffs[nstars:2*nstars]/flux, 0.)
+				shift_y = np.where(flux > 0, coeffs[2*nstars:3*nstars]/flux, 0.)
+			x = x + np.clip(shift_x, -1., 1.)
+			y = y + np.clip(shift_y, -1., 1.)
+
+	# Flux errors from the covariance matrix of the final linear fit
+	weighted = design*weights[:,None]
+	covariance = np.linalg.pinv(np.dot(weighted.T, weighted))
+	if variance is None:
+		# scaled by the residual scatter when the pixel variances are unknown
+		residuals = values - np.dot(design, coeffs)
+		dof = max(len(values) - design.shape[1], 1)
+		covariance = covariance*np.sum(residuals**2)/dof
+	flux_err = np.sqrt(np.diag(covariance)[:nstars])
+
+	return flux, flux_err, x, y
+
+
+def _fit_groups(jobs):
+	# Worker entry point: fit a batch of independent groups
+	results = []
+	for cutout, variance, x0, y0, psf, psf_dx, psf_dy, fit_radius, recenter in jobs:
+		results.append(fit_group(cutout, variance, x0, y0, psf, psf_dx, psf_dy, fit_radius, recenter))
+	return results
+
+
+def psf_photometry(data, xpix, ypix, psf, variance=None, fit_radius=6., recenter=2, workers=None, batch_size=200):
+	'''
+	PSF photometry of the stars at (xpix, ypix). Overlapping stars are fitted
+	simultaneously, and independent groups are fitted in parallel.
+	Returns the fluxes and their errors (NaN where the fit failed).
+	'''
+	xpix = np.asarray(xpix, dtype=np.float64)
+	ypix = np.asarray(ypix, dtype=np.float64)
+	fluxes = np.full(len(xpix), np.nan)
+	errors = np.full(len(xpix), np.nan)
+
+	# Stars outside the image cannot be fitted
+	ny, nx = data.shape
+	valid = np.nonzero(np.isfinite(xpix) & np.isfinite(ypix) & (xpix >= 0) & (xpix <= nx - 1) & (ypix >= 0) & (ypix <= ny - 1))[0]
+	if len(valid) == 0:
+		return fluxes, errors
+
+	psf_dy, psf_dx = np.gradient(psf)
+
+	# Prepare one job per group with the cutout covering all its stars
+	margin = int(np.ceil(fit_radius)) + 1
+	groups = []
+	jobs = []
+	for group in group_stars(xpix[valid], ypix[valid], 2.*fit_radius):
+		index = valid[group]
+		x1 = max(int(np.floor(np.min(xpix[index]))) - margin, 0)
+		x2 = min(int(np.ceil(np.max(xpix[index]))) + margin + 1, nx)
+		y1 = max(int(np.floor(np.min(ypix[index]))) - margin, 0)
+		y2 = min(int(np.ceil(np.max(ypix[index]))) + margin + 1, ny)
+		cutout = np.array(data[y1:y2, x1:x2], dtype=np.float64)
+		variance_cutout = None
+		if variance is not None:
+			variance_cutout = np.array(variance[y1:y2, x1:x2], dtype=np.float64)
+		groups.append(index)
+		jobs.append((cutout, variance_cutout, xpix[index] - x1, ypix[index] - y1, psf, psf_dx, psf_dy, fit_radius, recenter))
+
+	batches = [jobs[i:i+batch_size] for i in range(0, len(jobs), batch_size)]
+	if workers is None:
+		workers = os.cpu_count() or 1
+
+	if workers > 1 and len(batches) > 1:
+		with ProcessPoolExecutor(max_workers=workers) as executor:
+			results = [r for batch in executor.map(_fit_groups, batches) for r in batch]
+	else:
+		results = [r for batch in batches for r in _fit_groups(batch)]
+
+	for index, (flux, flux_err, _, _) in zip(groups, results):
+		fluxes[index] = flux
+		errors[index] = flux_err
+
+	return fluxes, errors
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+# © 2020 University of Oxford - Department of Physics
+# Physics Practical Course AS35 - Colour-magnitude diagrams of open clusters
+# Quality checks of calibration frames
+
+# Import Python Libraries
+import numpy as np
+from checkpoint import atomic_write, write_json
+
+
+def block_view(data, grid):
+	'''
+	View of an image (or a stack of images) as a grid of regions, with shape
+	(..., ny, nx, npix). Rows and columns that do not fill a region are dropped.
+	'''
+	ny, nx = grid
+	height = data.shape[-2]//ny
+	width = data.shape[-1]//nx
+	data = data[..., :ny*height, :nx*width]
+	blocks = data.reshape(data.shape[:-2] + (ny, height, nx, width))
+	blocks = np.moveaxis(blocks, -3, -2)
+	return blocks.reshape(blocks.shape[:-2] + (height*width,))
+
+
+def region_stats(data, grid=(4, 4), sigma=3.0, maxiters=5):
+	'''
+	Sigma clipped mean, median and standard deviation of every region of a grid,
+	computed for all the regions of a frame at once.
+	Each statistic has shape (ny, nx).
+	'''
+	values = np.array(block_view(np.asarray(data), grid), dtype=np.float32)
+	values[~np.isfinite(values)] = np.nan
+	for iteration in range(maxiters):
+		median = np.nanmedian(values, axis=-1)
+		std = np.nanstd(values, axis=-1)
+		clip = np.abs(values - median[..., None]) > sigma*std[..., None]
+		if not np.any(clip):
+			break
+		values[clip] = np.nan
+	return np.nanmean(values, axis=-1), np.nanmedian(values, axis=-1), np.nanstd(values, axis=-1)
+
+
+def flag_outliers(medians, stds, nsigma=5.0):
+	'''
+	Flag the frames whose region medians or standard deviations differ from
+	those of the other frames. medians and stds have shape (nframes, ny, nx).
+	A frame is flagged when its typical region deviates by more than nsigma,
+	or any of its regions by more than twice that.
+	Returns the deviation scores of the medians and of the standard deviations
+	(typical and largest over the regions) and the boolean flags of the frames.
+	'''
+	def score(values):
+		reference = np.median(values, axis=0)
+		scatter = 1.4826*np.median(np.abs(values - reference), axis=0)
+		# Avoid flagging everything when the frames are nearly identical
+		scatter = np.maximum(scatter, 0.1*np.median(stds, axis=0) + 1e-12)
+		deviation = np.abs(values - reference)/scatter
+		return np.median(deviation, axis=(1, 2)), np.max(deviation, axis=(1, 2))
+
+	medians = np.asarray(medians)
+	stds = np.asarray(stds)
+	if len(medians) < 3:
+		# Not enough frames to tell which ones are outliers
+		zeros = np.zeros(len(medians))
+		return zeros, zeros, zeros, np.zeros(len(medians), dtype=bool)
+
+	median_score, median_max = score(medians)
+	std_score, std_max = score(stds)
+	max_score = np.maximum(median_max, std_max)
+	flags = (median_score > nsigma) | (std_score > nsigma) | (max_score > 2*nsigma)
+	return median_score, std_score, max_score, flags
+
+
+def check_frames(stats, names, nsigma=5.0):
+	'''
+	Quality checks of the frames that will be combined, from the statistics of
+	their regions, i.e. the output of region_stats for each frame, computed as
+	the frames are read so that the whole stack is never copied.
+	Returns the report of the frames and the boolean flags of the outliers.
+	'''
+	means, medians, stds = [np.array(values) for values in zip(*stats)]
+
+	median_score, std_score, max_score, flags = flag_outliers(medians, stds, nsigma)
+
+	# Typical values of each frame over its regions
+	with np.errstate(invalid='ignore'):
+		frame_mean = np.nanmean(means, axis=(1, 2))
+		frame_median = np.nanmedian(medians, axis=(1, 2))
+		frame_std = np.nanmedian(stds, axis=(1, 2))
+
+	report = []
+	for i, name in enumerate(names):
+		report.append({
+			"file": name,
+			"mean": float(frame_mean[i]),
+			"median": float(frame_median[i]),
+			"std": float(frame_std[i]),
+			"median_score": float(median_score[i]),
+			"std_score": float(std_score[i]),
+			"max_score": float(max_score[i]),
+			"flagged": bool(flags[i]),
+		})
+	return report, flags
+
+
+def check_master(data, grid=(4, 4)):
+	'''
+	Quality checks of a master frame: the statistics of every region.
+	'''
+	mean, median, std = region_stats(data, grid)
+	return {
+		"grid": list(grid),
+		"mean": float(np.nanmean(mean)),
+		"std": float(np.nanmedian(std)),
+		"region_mean": mean.tolist(),
+		"region_median": median.tolist(),
+		"region_std": std.tolist(),
+	}
+
+
+def write_report(name, master, frames, json_file, html_file):
+	'''
+	Save the quality report as JSON and as an HTML summary.
+	'''
+	write_json({"master": name, "statistics": master, "frames": frames}, json_file)
+
+	html = ["<html><head><title>QA " + name + "</title></head><body>"]
+	html.append("<h1>" + name + "</h1>")
+	html.append("<p>mean = {:.4f}, std = {:.4f}</p>".format(master["mean"], master["std"]))
+	html.append("<h2>Region medians</h2><table border='1'>")
+	for row in master["region_median"][::-1]:
+		html.append("<tr>" + "".join("<td>{:.4f}</td>".format(v) for v in row) + "</tr>")
+	html.append("</table>")
+	html.append("<h2>Input frames</h2><table border='1'>")
+	html.append("<tr><th>file</th><th>mean</th><th>median</th><th>std</th><th>median score</th><th>std score</th><th>max score</th><th>flagged</th></tr>")
+	for frame in frames:
+		style = " style='background:#f88'" if frame["flagged"] else ""
+		html.append("<tr" + style + "><td>" + frame["file"] + "</td>" + "".join("<td>{:.4f}</td>".format(frame[k]) for k in ["mean", "median", "std", "median_score", "std_score", "max_score"]) + "<td>" + str(frame["flagged"]) + "</td></tr>")
+	html.append("</table></body></html>")
+	with atomic_write(html_file) as temporary:
+		with open(temporary, "w") as f:
+			f.write("\n".join(html))
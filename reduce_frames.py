@@ -7,83 +7,120 @@
 # Import Python Libraries
 import glob, os
 import sys
-import ccdproc
+import config
+
+# EDIT the settings in a run file (--config run.toml) or on the command line
+settings = config.load("reduce_frames", {
+	# Name of the cluster
+	"target": "NGC6939",
+	# Detector gain (e-/ADU) and read noise (e-), used when the frame header
+	# does not provide them
+	"gain": 1.0,
+	"read_noise": 10.0,
+	# Level (ADU) above which pixels are masked as saturated
+	"saturation": 50000.0,
+	# Detection threshold for cosmic rays (none to disable the detection)
+	"cosmic_sigclip": 5.0,
+	# Number of frames reduced in parallel (none to use all the CPUs)
+	"workers": None,
+	# Skip the frames already reduced by a previous run from the same inputs
+	"resume": True,
+}, "Calibrate the raw science frames of a target into <target>_frames")
+target = settings.target
+gain = settings.gain
+read_noise = settings.read_noise
+saturation = settings.saturation
+cosmic_sigclip = settings.cosmic_sigclip
+workers = settings.workers
+
 from ccdproc import CCDData
+from astropy.io import fits
 from astropy import units as u
-from astropy.stats import sigma_clipped_stats
-import numpy as np
+from reduction import frame_name, frame_inputs, read_masters, read_flat, calibrate_frame
+from checkpoint import Journal, write_fits
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import warnings
 from astropy.utils.exceptions import AstropyWarning
 warnings.simplefilter('ignore', category=AstropyWarning)
 warnings.filterwarnings('ignore')
 
-# EDIT the name of the cluster
-target = "NGC6939"
-##
-
-# Check that the master bias exists
-if os.path.isfile("master/master_bias.fits") != True:
-	print ("ERROR: master/master_bias.fits does not exist")
-	sys.exit()
-
-# Read the master bias
-master_bias = CCDData.read("master/master_bias.fits")
-
-# Check that the master dark exists
-if os.path.isfile("master/master_dark.fits") != True:
-	print ("ERROR: master/master_dark.fits does not exist")
-	sys.exit()
-
-# Read the master dark
-master_dark = CCDData.read("master/master_dark.fits")
+# Read the master bias, the master dark and the hot pixel mask
+master_bias, master_dark, hot_pixels = read_masters()
 
 # Create the output directory if needed
 if not os.path.exists(target + "_frames"):
 	os.makedirs(target + "_frames")
 
-# Find raw science frames
-sci_files = glob.glob(target + "/" + target + "*")
-# and reduce
-for i, sci in enumerate(sci_files):
+# Master flats and their effective divisors, loaded once per filter
+master_flats = {}
+
+def load_flat(filter_name):
+	if filter_name not in master_flats:
+		master_flats[filter_name] = read_flat(filter_name)
+
+	return master_flats[filter_name]
+
+def reduce_frame(sci):
 	# Read the science frame
 	ccd = CCDData.read(sci, unit = u.adu)
 
-	# Mask saturated pixels
-	mask_saturated = (ccd.data > 50000)
-	ccd.data = np.array(ccd.data, dtype=np.float32)
-	ccd.data[mask_saturated] = np.nan
-
 	# Load the appropriate flat field for this frame
 	filter_name = ccd.header["FILTER"].strip()
 
-	# Check that the master dark exists
-	if os.path.isfile("master/master_flat_" + filter_name + ".fits") != True:
-		print ("ERROR: master/master_flat_" + filter_name + ".fits")
-		sys.exit()
-
-	master_flat =  CCDData.read("master/master_flat_" + filter_name + ".fits")
-
-	# Subtract bias
-	ccd = ccdproc.subtract_bias(ccd, master_bias)
-
-	# Subtract dark current
-	ccd = ccdproc.subtract_dark(ccd, master_dark, dark_exposure=master_dark.header["EXPTIME"]*u.s, data_exposure=ccd.header["EXPTIME"]*u.s, scale=True)
+	master_flat, flat_squared = load_flat(filter_name)
 
-	# Divide by flat
-	ccd = ccdproc.flat_correct(ccd, master_flat, min_value=0.5)
-
-	# Subtract global sky background
-	mean, background, std = sigma_clipped_stats(ccd.data, sigma=3.0, maxiters=5)
-	ccd.data = ccd.data - background
-
-	# Divide by the exposure time
-	ccd.data = ccd.data/ccd.header["EXPTIME"]
-	ccd.unit = u.adu/u.s
-
-	# Add keywords to the header
-	ccd.header['SKY'] = background
+	# Calibrate it
+	ccd = calibrate_frame(ccd, master_bias, master_dark, master_flat, flat_squared, hot_pixels, gain, read_noise, saturation, cosmic_sigclip)
 	ccd.header['RAWFILE'] = sci
 
 	# Save the calibrated frame
-	ccd.write(target + "_frames/" + target + "_" + filter_name + "_" + '{:04d}'.format(i)  + ".fits" , clobber=True)
-	print ("Created " + target + "_frames/" + target + "_" + filter_name + "_" + '{:04d}'.format(i)  + ".fits")
+	output = frame_name(target, filter_name, sci)
+	write_fits(ccd, output)
+	print ("Created " + output)
+	return output
+
+# Worker processes may import this script, so only the main process reduces
+if __name__ == "__main__":
+	# Find raw science frames
+	sci_files = sorted(glob.glob(target + "/" + target + "*"))
+
+	# Remove the calibrated frames of these raw frames saved under another name,
+	# e.g. by an older version, so that they are not combined twice
+	for filename in sorted(glob.glob(target + "_frames/" + target + "_*.fits")):
+		header = fits.getheader(filename)
+		rawfile = header.get("RAWFILE")
+		if rawfile in sci_files and frame_name(target, header["FILTER"].strip(), rawfile) != filename:
+			print ("WARNING: removing " + filename + ", an old reduction of " + rawfile)
+			os.remove(filename)
+
+	# Skip the frames reduced by a previous run (or by watch.py) from the same
+	# raw frame, masters and settings, whose checksums are still valid
+	journal = Journal("reduce_frames", target + "_frames", settings.resume)
+	parameters = [gain, read_noise, saturation, cosmic_sigclip]
+	pending = []
+	for sci in sci_files:
+		filter_name = fits.getheader(sci)["FILTER"].strip()
+		inputs = frame_inputs(sci, filter_name)
+		if not journal.done(frame_name(target, filter_name, sci), inputs, parameters):
+			pending.append((sci, inputs))
+	if len(pending) < len(sci_files):
+		print ("Skipping " + str(len(sci_files) - len(pending)) + " frames already reduced")
+
+	# and reduce the others in parallel, recording each one as it completes,
+	# so that a frame which fails does not lose the frames completed after it
+	failed = []
+	with ProcessPoolExecutor(max_workers=workers) as executor:
+		futures = dict((executor.submit(reduce_frame, sci), (sci, inputs)) for sci, inputs in pending)
+		for future in as_completed(futures):
+			sci, inputs = futures[future]
+			try:
+				output = future.result()
+			except (Exception, SystemExit) as error:
+				print ("ERROR: " + sci + " could not be reduced: " + repr(error))
+				failed.append(sci)
+				continue
+			journal.record(output, inputs, parameters)
+
+	if len(failed) > 0:
+		print ("ERROR: " + str(len(failed)) + " frames could not be reduced: " + ", ".join(sorted(failed)))
+		sys.exit()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+
+# © 2020 University of Oxford - Department of Physics
+# Physics Practical Course AS35 - Colour-magnitude diagrams of open clusters
+# Calibration of a science frame with the master frames
+
+# Import Python Libraries
+import os
+import sys
+import ccdproc
+from ccdproc import CCDData
+from astropy.nddata import VarianceUncertainty
+from astropy.io import fits
+from astropy import units as u
+from astropy.stats import sigma_clipped_stats
+import numpy as np
+from cosmics import detect_cosmics
+
+
+def frame_name(target, filter_name, rawfile):
+	'''
+	Name of the calibrated frame of a raw frame, shared by reduce_frames.py and
+	watch.py: it only depends on the name of the raw frame, so it does not
+	change when new raw frames arrive.
+	'''
+	raw_name = os.path.splitext(os.path.basename(rawfile))[0]
+	return target + "_frames/" + target + "_" + filter_name + "_" + raw_name + ".fits"
+
+
+def frame_inputs(rawfile, filter_name, master_dir="master"):
+	'''
+	Files a calibrated frame is made from, recorded in the reduce_frames journal.
+	'''
+	return [rawfile, master_dir + "/master_bias.fits", master_dir + "/master_dark.fits", master_dir + "/hot_pixels.fits", master_dir + "/master_flat_" + filter_name + ".fits"]
+
+
+def read_masters(master_dir="master"):
+	'''
+	Read the master bias, the master dark and the hot pixel mask built from
+	the darks (None if there is none).
+	'''
+	# Check that the master bias exists
+	if os.path.isfile(master_dir + "/master_bias.fits") != True:
+		print ("ERROR: " + master_dir + "/master_bias.fits does not exist")
+		sys.exit()
+
+	# Read the master bias
+	master_bias = CCDData.read(master_dir + "/master_bias.fits")
+
+	# Check that the master dark exists
+	if os.path.isfile(master_dir + "/master_dark.fits") != True:
+		print ("ERROR: " + master_dir + "/master_dark.fits does not exist")
+		sys.exit()
+
+	# Read the master dark
+	master_dark = CCDData.read(master_dir + "/master_dark.fits")
+
+	# Read the hot pixel mask built from the darks, if any
+	hot_pixels = None
+	if os.path.isfile(master_dir + "/hot_pixels.fits"):
+		hot_pixels = fits.getdata(master_dir + "/hot_pixels.fits").astype(bool)
+
+	return master_bias, master_dark, hot_pixels
+
+
+def read_flat(filter_name, master_dir="master"):
+	'''
+	Read the master flat of a filter, and the square of the divisor applied by
+	flat_correct, used to scale the variance.
+	'''
+	# Check that the master flat exists
+	if os.path.isfile(master_dir + "/master_flat_" + filter_name + ".fits") != True:
+		print ("ERROR: " + master_dir + "/master_flat_" + filter_name + ".fits")
+		sys.exit()
+
+	master_flat = CCDData.read(master_dir + "/master_flat_" + filter_name + ".fits")
+
+	# flat_correct clips the flat at min_value and normalises it by its mean;
+	# keep the same divisor to scale the variance
+	divisor = np.array(master_flat.data, dtype=np.float32)
+	divisor[divisor < 0.5] = 0.5
+	divisor /= np.mean(divisor)
+	divisor **= 2
+	return master_flat, divisor
+
+
+def calibrate_frame(ccd, master_bias, master_dark, master_flat, flat_squared, hot_pixels=None, gain=1.0, read_noise=10.0, saturation=50000.0, cosmic_sigclip=5.0):
+	'''
+	Calibrate a raw science frame (in ADU): mask the saturated pixels, hot
+	pixels and cosmic rays, subtract the bias, the dark and the sky, divide by
+	the flat and the exposure time.
+	Returns the frame in ADU/s with its variance.
+	'''
+	# Mask saturated pixels
+	mask_saturated = (ccd.data > saturation)
+	ccd.data = np.array(ccd.data, dtype=np.float32)
+	ccd.data[mask_saturated] = np.nan
+	# and hot pixels
+	if hot_pixels is not None:
+		ccd.data[hot_pixels] = np.nan
+
+	# Subtract bias
+	ccd = ccdproc.subtract_bias(ccd, master_bias)
+
+	# Variance in ADU^2: photon noise of the bias subtracted signal plus read noise.
+	# It is kept as a separate float32 array and scaled in place, so ccdproc
+	# does not propagate (and copy) an uncertainty at every step
+	frame_gain = float(ccd.header.get("EGAIN", gain))
+	frame_read_noise = float(ccd.header.get("RDNOISE", read_noise))
+	variance = np.array(ccd.data, dtype=np.float32)
+	np.clip(variance, 0., None, out=variance)
+	variance /= frame_gain
+	variance += (frame_read_noise/frame_gain)**2
+
+	# Subtract dark current
+	ccd = ccdproc.subtract_dark(ccd, master_dark, dark_exposure=master_dark.header["EXPTIME"]*u.s, data_exposure=ccd.header["EXPTIME"]*u.s, scale=True)
+
+	# Mask cosmic rays
+	ncosmics = 0
+	if cosmic_sigclip is not None:
+		mask_cosmics = detect_cosmics(ccd.data, variance, sigclip=cosmic_sigclip)
+		ccd.data[mask_cosmics] = np.nan
+		variance[mask_cosmics] = np.nan
+		ncosmics = np.count_nonzero(mask_cosmics)
+
+	# Divide by flat
+	ccd = ccdproc.flat_correct(ccd, master_flat, min_value=0.5)
+	variance /= flat_squared
+
+	# Subtract global sky background
+	mean, background, std = sigma_clipped_stats(ccd.data, sigma=3.0, maxiters=5)
+	ccd.data = ccd.data - background
+
+	# Divide by the exposure time
+	ccd.data = ccd.data/ccd.header["EXPTIME"]
+	ccd.unit = u.adu/u.s
+	variance /= ccd.header["EXPTIME"]**2
+	ccd.uncertainty = VarianceUncertainty(variance)
+
+	# Add keywords to the header
+	ccd.header['SKY'] = background
+	ccd.header['NCOSMIC'] = ncosmics
+
+	return ccd
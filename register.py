@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+
+# © 2020 University of Oxford - Department of Physics
+# Physics Practical Course AS35 - Colour-magnitude diagrams of open clusters
+# Registration of reduced frames against a reference frame
+
+# Import Python Libraries
+import os
+import json
+import numpy as np
+from scipy import ndimage
+from scipy.spatial import cKDTree
+from astropy.io import fits
+from astropy import wcs
+from concurrent.futures import ProcessPoolExecutor
+from checkpoint import checksum, write_json
+
+
+def detect_bright_stars(data, nsigma=20., nmax=200, min_pixels=3, mask=None):
+	'''
+	Fast detection of the brightest stars: connected pixels above nsigma times
+	the noise, measured with the MAD of a sub-sample of the image.
+	The pixels of mask (e.g. without data) are ignored.
+	Returns the x and y centroids of the nmax brightest sources.
+	'''
+	sample = data[::4, ::4]
+	if mask is not None:
+		sample = sample[~mask[::4, ::4]]
+	sample = sample[np.isfinite(sample)]
+	if len(sample) == 0:
+		return np.array([]), np.array([])
+	median = np.median(sample)
+	std = 1.4826*np.median(np.abs(sample - median))
+
+	# Saturated pixels are NaN: treat them as the brightest pixels of their star
+	image = np.where(np.isfinite(data), data - median, np.nanmax(data) - median)
+	if mask is not None:
+		image[mask] = 0.
+	labels, nlabels = ndimage.label(image > nsigma*std)
+	if nlabels == 0:
+		return np.array([]), np.array([])
+
+	index = np.arange(1, nlabels + 1)
+	npix = ndimage.sum_labels(np.ones_like(image), labels, index)
+	flux = ndimage.sum_labels(image, labels, index)
+	index = index[npix >= min_pixels]
+	flux = flux[npix >= min_pixels]
+	index = index[np.argsort(flux)[::-1][:nmax]]
+	if len(index) == 0:
+		return np.array([]), np.array([])
+
+	centroids = np.array(ndimage.center_of_mass(image, labels, index))
+	return centroids[:,1], centroids[:,0]
+
+
+def match_offset(x, y, xref, yref, search_radius=30., tolerance=1.5):
+	'''
+	Offset (dx, dy) that maps the stars (x, y) onto the reference stars.
+	All the pairs within search_radius vote for the offset, and the offset is
+	then refined with the median of the matched pairs.
+	Returns dx, dy and the number of matched stars.
+	'''
+	if len(x) == 0 or len(xref) == 0:
+		return 0., 0., 0
+
+	tree = cKDTree(np.array([xref, yref]).T)
+	points = np.array([x, y]).T
+	pairs = tree.query_ball_point(points, r=search_radius)
+	i = np.repeat(np.arange(len(points)), [len(p) for p in pairs])
+	j = np.concatenate([np.array(p, dtype=int) for p in pairs])
+	if len(j) == 0:
+		return 0., 0., 0
+	dx = xref[j] - x[i]
+	dy = yref[j] - y[i]
+
+	# Most common offset
+	nbins = int(np.ceil(2*search_radius/tolerance))
+	hist, xedges, yedges = np.histogram2d(dx, dy, bins=nbins, range=[[-search_radius, search_radius], [-search_radius, search_radius]])
+	ix, iy = np.unravel_index(np.argmax(hist), hist.shape)
+	offset_x = 0.5*(xedges[ix] + xedges[ix+1])
+	offset_y = 0.5*(yedges[iy] + yedges[iy+1])
+
+	# Refine with the nearest reference star of every shifted star
+	for iteration in range(3):
+		distance, nearest = tree.query(points + [offset_x, offset_y], distance_upper_bound=tolerance)
+		matched = np.isfinite(distance)
+		if np.count_nonzero(matched) == 0:
+			return offset_x, offset_y, 0
+		offset_x = np.median(xref[nearest[matched]] - x[matched])
+		offset_y = np.median(yref[nearest[matched]] - y[matched])
+
+	return offset_x, offset_y, int(np.count_nonzero(matched))
+
+
+def reference_stars(filename, nsigma=20., nmax=200):
+	'''
+	Bright stars of the reference frame, in its pixel coordinates, with its WCS.
+	'''
+	hdulist = fits.open(filename)
+	data = hdulist[0].data
+	header = hdulist[0].header
+	hdulist.close()
+	xref, yref = detect_bright_stars(data, nsigma, nmax)
+	return xref, yref, header
+
+
+def register_frame(filename, xref, yref, ref_header, nsigma=20., nmax=200, search_radius=30.):
+	'''
+	Correction to the CRVAL keywords of a frame, measured by matching its bright
+	stars, projected with its own WCS, with the stars of the reference frame.
+	Returns the corrections in RA and Dec (degrees), the number of matches
+	and the number of stars predicted to fall on the reference frame.
+	'''
+	hdulist = fits.open(filename)
+	data = hdulist[0].data
+	header = hdulist[0].header
+	hdulist.close()
+
+	x, y = detect_bright_stars(data, nsigma, nmax)
+	if len(x) == 0:
+		return 0., 0., 0, 0
+
+	# Predicted positions in the reference frame
+	w = wcs.WCS(header)
+	ref_wcs = wcs.WCS(ref_header)
+	ra, dec = w.all_pix2world(x, y, 0)
+	xpred, ypred = ref_wcs.all_world2pix(ra, dec, 0)
+	noverlap = np.count_nonzero((xpred > -search_radius) & (xpred < ref_header["NAXIS1"] + search_radius) & (ypred > -search_radius) & (ypred < ref_header["NAXIS2"] + search_radius))
+
+	dx, dy, nmatch = match_offset(xpred, ypred, xref, yref, search_radius)
+
+	# Convert the offset into a shift of the sky coordinates
+	ra_true, dec_true = ref_wcs.all_pix2world(xpred + dx, ypred + dy, 0)
+	dra = np.median(((ra_true - ra + 180.) % 360.) - 180.)
+	ddec = np.median(dec_true - dec)
+
+	return float(dra), float(ddec), nmatch, int(noverlap)
+
+
+def apply_correction(ccd, dra, ddec):
+	'''
+	Apply a correction measured by register_frame to a frame read with
+	CCDData.read, which moves the WCS keywords from the header to ccd.wcs.
+	'''
+	ccd.wcs.wcs.crval = ccd.wcs.wcs.crval + np.array([dra, ddec])
+	return ccd
+
+
+def _register(args):
+	# Worker entry point
+	return register_frame(*args)
+
+
+def register_frames(filenames, reference, cache_file=None, workers=None, nsigma=20., nmax=200, search_radius=30.):
+	'''
+	Register the frames against the reference frame, in parallel.
+	Results are cached in cache_file by the checksums of the frame and the reference.
+	Returns a dictionary filename -> (dra, ddec, nmatch, noverlap).
+	'''
+	cache = {}
+	if cache_file is not None and os.path.isfile(cache_file):
+		with open(cache_file, "r") as f:
+			cache = json.load(f)
+
+	ref_checksum = checksum(reference)
+	checksums = {}
+	pending = []
+	for filename in filenames:
+		checksums[filename] = checksum(filename) + "_" + ref_checksum
+		if checksums[filename] not in cache:
+			pending.append(filename)
+
+	if len(pending) > 0:
+		xref, yref, ref_header = reference_stars(reference, nsigma, nmax)
+		jobs = [(filename, xref, yref, ref_header, nsigma, nmax, search_radius) for filename in pending]
+		if workers is None:
+			workers = os.cpu_count() or 1
+		if workers > 1 and len(jobs) > 1:
+			with ProcessPoolExecutor(max_workers=workers) as executor:
+				results = list(executor.map(_register, jobs))
+		else:
+			results = [_register(job) for job in jobs]
+
+		for filename, result in zip(pending, results):
+			cache[checksums[filename]] = list(result)
+
+		if cache_file is not None:
+			write_json(cache, cache_file)
+
+	return dict((filename, tuple(cache[checksums[filename]])) for filename in filenames)
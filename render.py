@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+# © 2020 University of Oxford - Department of Physics
+# Physics Practical Course AS35 - Colour-magnitude diagrams of open clusters
+# Rasterized plots of large catalogues
+
+# Import Python Libraries
+# matplotlib is only imported by the plotting functions, the axes are given
+import numpy as np
+from scipy import ndimage
+
+
+def decimate(npoints, max_points, seed=0):
+	'''
+	Indices of a random subset of at most max_points of npoints points, the
+	same for every call, e.g. to keep interactive plots responsive.
+	'''
+	if npoints <= max_points:
+		return np.arange(npoints)
+	rng = np.random.default_rng(seed)
+	return np.sort(rng.choice(npoints, max_points, replace=False))
+
+
+def density_image(x, y, bins=(400, 400), range=None, weights=None):
+	'''
+	Number of points in every pixel of a grid, with a single histogram.
+	Returns the image, with y along the first axis, and its extent
+	(xmin, xmax, ymin, ymax).
+	'''
+	x = np.asarray(x, dtype=float)
+	y = np.asarray(y, dtype=float)
+	good = np.isfinite(x) & np.isfinite(y)
+	if weights is not None:
+		weights = np.asarray(weights, dtype=float)[good]
+	if range is None:
+		range = [[np.min(x[good]), np.max(x[good])], [np.min(y[good]), np.max(y[good])]]
+	image, xedges, yedges = np.histogram2d(x[good], y[good], bins=bins, range=range, weights=weights)
+	return image.T, (xedges[0], xedges[-1], yedges[0], yedges[-1])
+
+
+def plot_density(ax, x, y, bins=(400, 400), range=None, weights=None, cmap="Greys", label=None):
+	'''
+	Plot a point cloud as a density image with a logarithmic scale. The plot
+	time and file size only depend on the number of bins.
+	'''
+	from matplotlib.colors import LogNorm
+
+	image, extent = density_image(x, y, bins, range, weights)
+	image[image <= 0] = np.nan
+	vmax = np.nanmax(image) if np.any(np.isfinite(image)) else 1.
+	return ax.imshow(image, extent=extent, origin="lower", aspect="auto", interpolation="nearest", cmap=cmap, norm=LogNorm(vmin=min(1., vmax), vmax=vmax), label=label)
+
+
+def downsample(data, factor):
+	'''
+	Image binned by factor x factor pixels (NaN are ignored), for display.
+	'''
+	if factor <= 1:
+		return data
+	ny = data.shape[0]//factor
+	nx = data.shape[1]//factor
+	blocks = np.asarray(data[:ny*factor, :nx*factor], dtype=np.float32).reshape(ny, factor, nx, factor)
+	return np.nanmean(blocks, axis=(1, 3))
+
+
+def display_factor(shape, max_size=2000):
+	'''
+	Downsampling factor so that the larger axis of an image has at most max_size pixels.
+	'''
+	return max(1, int(np.ceil(max(shape)/float(max_size))))
+
+
+def source_overlay(xpix, ypix, shape, radius=5., factor=1, color=(1., 0., 0.), alpha=0.5):
+	'''
+	RGBA image of circles of the given radius (original pixels) around the
+	sources, on the image downsampled by factor. All the sources are drawn with
+	one histogram and one convolution, instead of one patch each.
+	'''
+	ny = shape[0]//factor
+	nx = shape[1]//factor
+	counts, _ = density_image((np.asarray(xpix) + 0.5)/factor - 0.5, (np.asarray(ypix) + 0.5)/factor - 0.5, bins=(nx, ny), range=[[-0.5, nx - 0.5], [-0.5, ny - 0.5]])
+
+	# Ring kernel one display pixel wide
+	r = max(radius/factor, 1.)
+	size = int(np.ceil(r)) + 1
+	yy, xx = np.mgrid[-size:size + 1, -size:size + 1]
+	ring = (np.abs(np.hypot(xx, yy) - r) < 0.5).astype(np.float32)
+	circles = ndimage.convolve((counts > 0).astype(np.float32), ring, mode="constant") > 0
+
+	overlay = np.zeros((ny, nx, 4), dtype=np.float32)
+	overlay[circles, :3] = color
+	overlay[circles, 3] = alpha
+	return overlay
+
+
+def plot_image(ax, data, xpix=None, ypix=None, radius=5., norm=None, cmap="Greys", max_size=2000):
+	'''
+	Plot an image downsampled to at most max_size pixels, with circles around
+	the sources drawn as a single raster layer. The axes keep the pixel
+	coordinates of the original image.
+	'''
+	factor = display_factor(data.shape, max_size)
+	extent = (-0.5, data.shape[1]//factor*factor - 0.5, -0.5, data.shape[0]//factor*factor - 0.5)
+	ax.imshow(downsample(data, factor), cmap=cmap, origin="lower", norm=norm, extent=extent, interpolation="nearest")
+	if xpix is not None and len(xpix) > 0:
+		ax.imshow(source_overlay(xpix, ypix, data.shape, radius, factor), origin="lower", extent=extent, interpolation="nearest")
+	return factor
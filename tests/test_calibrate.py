@@ -0,0 +1,60 @@
+# © 2020 University of Oxford - Department of Physics
+# Physics Practical Course AS35 - Colour-magnitude diagrams of open clusters
+# Tests of the photometric calibration
+
+import numpy as np
+import calibrate
+
+
+def synthetic_field(rng, nstars=200):
+	ra = 10. + rng.uniform(-0.1, 0.1, nstars)
+	dec = 60. + rng.uniform(-0.1, 0.1, nstars)
+	mag_v = rng.uniform(11., 17., nstars)
+	mag_b = mag_v + rng.uniform(0., 1.5, nstars)
+	return ra, dec, mag_b, mag_v
+
+
+def test_cross_match_within_radius():
+	ra = np.array([10., 10.01, 10.02])
+	dec = np.array([60., 60., 60.])
+	stars, refs = calibrate.cross_match(ra, dec, ra[::-1] + 0.5/3600, dec[::-1], radius=2.0)
+	assert list(stars) == [0, 1, 2]
+	assert list(refs) == [2, 1, 0]
+	stars, refs = calibrate.cross_match(ra, dec, ra + 5./3600, dec, radius=2.0)
+	assert len(stars) == 0
+
+
+def test_single_airmass_uses_the_configured_extinction():
+	rng = np.random.default_rng(9)
+	ra, dec, mag_b, mag_v = synthetic_field(rng)
+	colour = mag_b - mag_v
+	airmass = 1.3
+	inst_v = mag_v - 20. - 0.05*colour + 0.15*airmass + rng.normal(0, 0.01, len(ra))
+	# a few blended stars
+	inst_v[:5] -= 1.
+	solution = calibrate.solve(inst_v, mag_v, colour, airmass, extinction=0.15)
+	assert abs(solution["zeropoint"] - 20.) < 0.01
+	assert abs(solution["colour_term"] - 0.05) < 0.01
+	assert solution["extinction"] == 0.15
+	# the blended stars, and maybe a 3 sigma deviation, are clipped
+	assert len(ra) - 10 <= solution["nstars"] <= len(ra) - 5
+
+
+def test_calibrated_magnitudes():
+	rng = np.random.default_rng(10)
+	ra, dec, mag_b, mag_v = synthetic_field(rng)
+	colour = mag_b - mag_v
+	inst_b = mag_b - 19.5 + 0.1*colour + 0.25*1.2
+	inst_v = mag_v - 19.8 - 0.05*colour + 0.15*1.25
+	catalogue = {"ra": ra[:50], "dec": dec[:50], "B": mag_b[:50], "V": mag_v[:50], "B_err": np.zeros(50), "V_err": np.zeros(50)}
+	cal_b, cal_v, solution_b, solution_v = calibrate.calibrate(ra, dec, inst_b, inst_v, 1.2, 1.25, catalogue, extinction_b=0.25, extinction_v=0.15)
+	assert np.allclose(cal_b, mag_b, atol=1e-6)
+	assert np.allclose(cal_v, mag_v, atol=1e-6)
+
+
+def test_too_few_matches():
+	rng = np.random.default_rng(11)
+	ra, dec, mag_b, mag_v = synthetic_field(rng, 2)
+	catalogue = {"ra": ra, "dec": dec, "B": mag_b, "V": mag_v, "B_err": np.zeros(2), "V_err": np.zeros(2)}
+	cal_b, cal_v, solution_b, solution_v = calibrate.calibrate(ra, dec, mag_b, mag_v, 1.0, 1.0, catalogue)
+	assert cal_b is None and solution_b is None
@@ -0,0 +1,144 @@
+# © 2020 University of Oxford - Department of Physics
+# Physics Practical Course AS35 - Colour-magnitude diagrams of open clusters
+# Tests of the journals and of the resumed reduction of the science frames
+
+import os
+import subprocess
+import sys
+import numpy as np
+from astropy.io import fits
+from astropy.wcs import WCS
+from checkpoint import Journal, atomic_write, write_fits
+from reduction import frame_name
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_journal(tmp_path):
+	source = tmp_path / "input.txt"
+	source.write_text("1 2 3\n")
+	output = str(tmp_path / "output.fits")
+	write_fits(fits.HDUList([fits.PrimaryHDU(np.ones((4, 4), dtype=np.float32))]), output)
+
+	journal = Journal("stage", str(tmp_path))
+	assert not journal.done(output, [str(source)], [1.0])
+	journal.record(output, [str(source)], [1.0])
+	journal = Journal("stage", str(tmp_path))
+	assert journal.done(output, [str(source)], [1.0])
+	# Other settings, a changed input or a corrupted output are made again
+	assert not journal.done(output, [str(source)], [2.0])
+	assert not Journal("stage", str(tmp_path), resume=False).done(output, [str(source)], [1.0])
+	with open(output, "r+b") as f:
+		f.seek(-8, 2)
+		f.write(b"corrupt!")
+	assert not journal.done(output, [str(source)], [1.0])
+	write_fits(fits.HDUList([fits.PrimaryHDU(np.ones((4, 4), dtype=np.float32))]), output)
+	source.write_text("1 2 3 4\n")
+	assert not journal.done(output, [str(source)], [1.0])
+
+
+def test_concurrent_journals_keep_each_others_entries(tmp_path):
+	outputs = []
+	for name in ["a.txt", "b.txt", "c.txt"]:
+		(tmp_path / name).write_text(name)
+		outputs.append(str(tmp_path / name))
+	# Two runs of the same stage, each loading the journal before the other records
+	first = Journal("stage", str(tmp_path))
+	second = Journal("stage", str(tmp_path))
+	first.record(outputs[0], [], [1.0])
+	second.record(outputs[1], [], [1.0])
+	first.record(outputs[2], [], [1.0])
+	journal = Journal("stage", str(tmp_path))
+	assert all(journal.done(output, [], [1.0]) for output in outputs)
+
+
+def test_atomic_write(tmp_path):
+	output = tmp_path / "output.txt"
+	output.write_text("old")
+	try:
+		with atomic_write(str(output)) as temporary:
+			with open(temporary, "w") as f:
+				f.write("partial")
+			raise RuntimeError
+	except RuntimeError:
+		pass
+	assert output.read_text() == "old"
+	assert os.listdir(tmp_path) == ["output.txt"]
+
+
+def test_frame_name():
+	assert frame_name("T", "V", "T/T-0007V.fits") == "T_frames/T_V_T-0007V.fits"
+	assert frame_name("T", "V", "raw/T-0007V.fit") == "T_frames/T_V_T-0007V.fits"
+
+
+def write_raw(directory, name, filter_name, rng):
+	w = WCS(naxis=2)
+	w.wcs.ctype = ["RA---TAN", "DEC--TAN"]
+	w.wcs.crpix = [32, 32]
+	w.wcs.crval = [10., 60.]
+	w.wcs.cdelt = [-1/3600., 1/3600.]
+	header = w.to_header()
+	header["FILTER"] = filter_name
+	header["EXPTIME"] = 60.
+	header["IMAGETYP"] = "Light Frame"
+	data = rng.normal(150., 5., (64, 64)).astype(np.float32)
+	fits.PrimaryHDU(data, header).writeto(os.path.join(directory, name))
+
+
+def write_masters(directory):
+	# Flat masters, with a V flat only
+	os.makedirs(directory / "T")
+	os.makedirs(directory / "master")
+	for name, value, exptime in [("master_bias", 100., None), ("master_dark", 0., 60.), ("master_flat_V", 1., None)]:
+		hdu = fits.PrimaryHDU(np.full((64, 64), value, dtype=np.float32))
+		hdu.header["BUNIT"] = "adu"
+		if exptime is not None:
+			hdu.header["EXPTIME"] = exptime
+		hdu.writeto(directory / "master" / (name + ".fits"))
+
+
+def test_resume(tmp_path):
+	rng = np.random.default_rng(3)
+	write_masters(tmp_path)
+	for i in [2, 3]:
+		write_raw(tmp_path / "T", "T-%03dV.fits" % i, "V", rng)
+
+	command = [sys.executable, os.path.join(ROOT, "reduce_frames.py"), "--target", "T", "--workers", "1"]
+	subprocess.run(command, cwd=tmp_path, check=True, capture_output=True)
+	frames = sorted(os.listdir(tmp_path / "T_frames"))
+	assert frames == ["T_V_T-002V.fits", "T_V_T-003V.fits", "reduce_frames.journal"]
+	mtimes = dict((name, os.path.getmtime(tmp_path / "T_frames" / name)) for name in frames)
+
+	# A frame saved under an older name is removed
+	os.rename(tmp_path / "T_frames" / "T_V_T-003V.fits", tmp_path / "T_frames" / "T_V_0001.fits")
+	# and a new raw frame sorting first does not rename or reduce the others again
+	write_raw(tmp_path / "T", "T-001V.fits", "V", rng)
+	result = subprocess.run(command, cwd=tmp_path, check=True, capture_output=True, text=True)
+	assert "removing T_frames/T_V_0001.fits" in result.stdout
+	assert sorted(os.listdir(tmp_path / "T_frames")) == ["T_V_T-001V.fits", "T_V_T-002V.fits", "T_V_T-003V.fits", "reduce_frames.journal"]
+	assert os.path.getmtime(tmp_path / "T_frames" / "T_V_T-002V.fits") == mtimes["T_V_T-002V.fits"]
+	with fits.open(tmp_path / "T_frames" / "T_V_T-001V.fits") as hdulist:
+		assert hdulist[0].header["RAWFILE"] == "T/T-001V.fits"
+
+	# The frames reduced by watch.py are recorded in the same journal
+	write_raw(tmp_path / "T", "T-004V.fits", "V", rng)
+	watch = [sys.executable, os.path.join(ROOT, "watch.py"), "--target", "T", "--once", "--poll_interval", "0.1"]
+	subprocess.run(watch, cwd=tmp_path, check=True, capture_output=True)
+	result = subprocess.run(command, cwd=tmp_path, check=True, capture_output=True, text=True)
+	assert "Skipping 4 frames already reduced" in result.stdout
+
+
+def test_failed_frame_does_not_lose_the_others(tmp_path):
+	rng = np.random.default_rng(4)
+	write_masters(tmp_path)
+	# There is no B flat, so the B frame fails, before and after V frames
+	write_raw(tmp_path / "T", "T-001V.fits", "V", rng)
+	write_raw(tmp_path / "T", "T-002B.fits", "B", rng)
+	for i in range(3, 7):
+		write_raw(tmp_path / "T", "T-%03dV.fits" % i, "V", rng)
+
+	command = [sys.executable, os.path.join(ROOT, "reduce_frames.py"), "--target", "T", "--workers", "2"]
+	result = subprocess.run(command, cwd=tmp_path, check=True, capture_output=True, text=True)
+	assert "1 frames could not be reduced: T/T-002B.fits" in result.stdout
+	result = subprocess.run(command, cwd=tmp_path, check=True, capture_output=True, text=True)
+	assert "Skipping 5 frames already reduced" in result.stdout
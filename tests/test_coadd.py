@@ -0,0 +1,100 @@
+# © 2020 University of Oxford - Department of Physics
+# Physics Practical Course AS35 - Colour-magnitude diagrams of open clusters
+# Tests of the co-addition of frames
+
+import numpy as np
+from scipy.signal import medfilt
+from scipy import ndimage
+from coadd import RunningCoadd, ClippedCoadd, lowexposure_mask
+
+
+def clipped(frames, weights, variances=None, buffer_size=25):
+	coadd = ClippedCoadd(frames[0].shape, buffer_size=buffer_size)
+	for i, frame in enumerate(frames):
+		coadd.sample(frame, None if variances is None else variances[i])
+	coadd.clip_limits(sigma=3., maxiters=5)
+	for i, frame in enumerate(frames):
+		coadd.add(frame, weights[i], None if variances is None else variances[i])
+	return coadd.result()
+
+
+def test_lone_outlier_is_rejected_among_few_frames():
+	frames = [np.full((4, 4), value, dtype=np.float32) for value in [1.0, 1.1, 0.9]]
+	frames[1][2, 2] = 100.
+	weights = [np.ones((4, 4))]*3
+	variances = [np.full((4, 4), 0.01)]*3
+	mean, weight, variance = clipped(frames, weights, variances)
+	assert abs(mean[2, 2] - 0.95) < 1e-5
+	assert weight[2, 2] == 2
+	assert abs(mean[0, 0] - 1.0) < 1e-5
+	assert weight[0, 0] == 3
+
+
+def test_clean_stack_matches_the_weighted_mean():
+	rng = np.random.default_rng(1)
+	frames = [rng.normal(10., 1., (20, 20)).astype(np.float32) for i in range(8)]
+	weights = [np.full((20, 20), 1. + i) for i in range(8)]
+	variances = [np.ones((20, 20))]*8
+	running = RunningCoadd((20, 20))
+	for frame, weight, variance in zip(frames, weights, variances):
+		running.add(frame, weight, variance)
+	expected = running.result()[0]
+	mean, weight, variance = clipped(frames, weights, variances)
+	# only a handful of 3 sigma deviations may be clipped
+	assert np.count_nonzero(weight < np.sum(weights, axis=0)[0, 0]) < 10
+	close = weight == np.sum(weights, axis=0)[0, 0]
+	assert np.allclose(mean[close], expected[close], atol=1e-5)
+
+
+def test_memory_does_not_grow_with_the_number_of_frames():
+	rng = np.random.default_rng(2)
+	coadd = ClippedCoadd((10, 10), buffer_size=5)
+	for i in range(200):
+		frame = rng.normal(0., 1., (10, 10)).astype(np.float32)
+		frame[3, 3] = np.nan
+		if i == 50:
+			frame[5, 5] = 1000.
+		coadd.sample(frame)
+	assert coadd.buffer.shape == (5, 10, 10)
+	assert np.all(coadd.count[3, 3] == 0)
+	coadd.clip_limits()
+	assert coadd.buffer is None
+	assert coadd.upper[5, 5] < 10.
+	assert np.isnan(coadd.upper[3, 3])
+
+
+def medfilt_mask(exposure_map, size=15, fraction=0.5):
+	# The masking done with medfilt before lowexposure_mask
+	filtered = medfilt(exposure_map, (size, size))
+	return filtered < np.median(filtered)*fraction
+
+
+def discrete_map(shape, rng):
+	# Overlapping frames with integer exposures, as in a dithered mosaic
+	exposure_map = np.zeros(shape)
+	for i in range(12):
+		y, x = rng.integers(0, shape[0]//2), rng.integers(0, shape[1]//2)
+		exposure_map[y:y + shape[0]//2, x:x + shape[1]//2] += 60.
+	return exposure_map
+
+
+def test_lowexposure_mask_matches_medfilt():
+	rng = np.random.default_rng(9)
+	for shape in [(120, 97), (100, 80)]:
+		exposure_map = discrete_map(shape, rng)
+		assert np.array_equal(lowexposure_mask(exposure_map), medfilt_mask(exposure_map))
+
+		# Interpolated edges and noise, so that almost every value is different
+		noisy = ndimage.gaussian_filter(exposure_map, 3.) + rng.normal(0., 2., shape)
+		assert np.array_equal(lowexposure_mask(noisy), medfilt_mask(noisy))
+		assert np.array_equal(lowexposure_mask(noisy, size=5, fraction=0.8), medfilt_mask(noisy, size=5, fraction=0.8))
+
+
+def test_lowexposure_mask_is_exact_with_few_samples():
+	# With a handful of sampled windows the median falls outside the sampled
+	# values around it, and is found among the values of the map
+	rng = np.random.default_rng(10)
+	for i in range(5):
+		exposure_map = ndimage.gaussian_filter(discrete_map((90, 110), rng), 2.) + rng.normal(0., 5., (90, 110))
+		assert np.array_equal(lowexposure_mask(exposure_map, nsamples=7), medfilt_mask(exposure_map))
+		assert np.array_equal(lowexposure_mask(exposure_map, size=3, nsamples=3), medfilt_mask(exposure_map, size=3))
@@ -0,0 +1,38 @@
+# © 2020 University of Oxford - Department of Physics
+# Physics Practical Course AS35 - Colour-magnitude diagrams of open clusters
+# Tests of the run configuration
+
+import os
+import subprocess
+import sys
+import pytest
+import config
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_precedence_of_the_settings(tmp_path, monkeypatch):
+	monkeypatch.delenv("AS35_CONFIG", raising=False)
+	run_file = tmp_path / "run.toml"
+	run_file.write_text('target = "NGC0001"\nsigma = 2.0\n[stage]\nsigma = 4.0\nsize = [3, 5]\n')
+	defaults = {"target": "NGC0663", "sigma": 3.0, "size": (1, 1), "flag": True, "workers": None}
+	settings = config.load("stage", defaults, argv=["--config", str(run_file), "--no-flag", "--workers", "4"])
+	assert settings.target == "NGC0001"
+	assert settings.sigma == 4.0
+	assert settings.size == (3, 5)
+	assert settings.flag is False
+	assert settings.workers == 4
+
+
+def test_unknown_setting_is_rejected(tmp_path, capsys):
+	run_file = tmp_path / "run.toml"
+	run_file.write_text('[stage]\nsigam = 4.0\n')
+	with pytest.raises(SystemExit):
+		config.load("stage", {"sigma": 3.0}, argv=["--config", str(run_file)])
+	assert "ERROR: unknown setting sigam" in capsys.readouterr().out
+
+
+def test_isofit_does_not_import_matplotlib():
+	code = "import sys, isofit; print('matplotlib' in sys.modules)"
+	result = subprocess.run([sys.executable, "-c", code], cwd=ROOT, capture_output=True, text=True, check=True)
+	assert result.stdout.strip() == "False"
@@ -0,0 +1,76 @@
+# © 2020 University of Oxford - Department of Physics
+# Physics Practical Course AS35 - Colour-magnitude diagrams of open clusters
+# Tests of the cosmic ray and hot pixel detection
+
+import numpy as np
+import pytest
+from cosmics import detect_cosmics, hot_pixels
+
+
+def star_field(seed, size=512, nstars=300, fwhm=3.5, sky=100., read_noise=10.):
+	'''
+	Bias subtracted frame of well sampled stars, with its variance.
+	'''
+	rng = np.random.default_rng(seed)
+	sigma = fwhm/2.3548
+	image = np.full((size, size), sky)
+	xs = rng.uniform(5, size - 5, nstars)
+	ys = rng.uniform(5, size - 5, nstars)
+	yy, xx = np.mgrid[-12:13, -12:13]
+	for x, y, flux in zip(xs, ys, 10**rng.uniform(2.5, 5.5, nstars)):
+		xi = int(x)
+		yi = int(y)
+		stamp = flux/(2*np.pi*sigma**2)*np.exp(-((xx + xi - x)**2 + (yy + yi - y)**2)/(2*sigma**2))
+		y1 = max(yi - 12, 0)
+		x1 = max(xi - 12, 0)
+		y2 = min(yi + 13, size)
+		x2 = min(xi + 13, size)
+		image[y1:y2, x1:x2] += stamp[y1 - yi + 12:y2 - yi + 12, x1 - xi + 12:x2 - xi + 12]
+	image = rng.poisson(image) + rng.normal(0., read_noise, image.shape)
+	variance = np.clip(image, 0, None) + read_noise**2
+	return image - sky, variance, xs, ys, rng
+
+
+@pytest.mark.parametrize("seed", [0, 1, 6])
+def test_stars_are_not_masked(seed):
+	image, variance, xs, ys, rng = star_field(seed)
+	assert np.count_nonzero(detect_cosmics(image, variance)) == 0
+
+
+@pytest.mark.parametrize("seed", [0, 1])
+def test_injected_hits_are_caught(seed):
+	image, variance, xs, ys, rng = star_field(seed)
+	# Single pixel hits and short tracks away from the stars
+	hits = []
+	while len(hits) < 40:
+		y, x = rng.integers(5, image.shape[0] - 5, 2)
+		if np.min(np.hypot(x - xs, y - ys)) > 6:
+			hits.append((y, x))
+	for i, (y, x) in enumerate(hits):
+		energy = rng.uniform(300., 3000.)
+		image[y, x] += energy
+		variance[y, x] += energy
+		if i % 2:
+			image[y, x + 1] += 0.5*energy
+			variance[y, x + 1] += 0.5*energy
+	mask = detect_cosmics(image, variance)
+	y, x = np.array(hits).T
+	assert np.all(mask[y, x])
+	assert np.all(mask[y[1::2], x[1::2] + 1])
+	# and nothing else than the hits and their edges
+	assert np.count_nonzero(mask) < 3*len(hits)
+
+
+def test_masked_pixels_are_ignored():
+	image, variance, xs, ys, rng = star_field(2, size=128, nstars=10)
+	image[60, 60] = np.nan
+	image[30, 30] += 2000.
+	mask = detect_cosmics(image, variance)
+	assert mask[30, 30] and not mask[60, 60]
+
+
+def test_hot_pixels():
+	rng = np.random.default_rng(8)
+	dark = rng.normal(10., 1., (100, 100))
+	dark[20, 30] = 500.
+	assert list(zip(*np.nonzero(hot_pixels(dark)))) == [(20, 30)]
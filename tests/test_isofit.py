@@ -0,0 +1,46 @@
+# © 2020 University of Oxford - Department of Physics
+# Physics Practical Course AS35 - Colour-magnitude diagrams of open clusters
+# Tests of the isochrone fitting
+
+import os
+import numpy as np
+import pytest
+import isofit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_missing_data_file_is_an_error(tmp_path, capsys, monkeypatch):
+	monkeypatch.delenv("AS35_CONFIG", raising=False)
+	with pytest.raises(SystemExit):
+		isofit.main(["isofit", str(tmp_path / "missing.txt"), os.path.join(ROOT, "PadovaCMD.dat")])
+	out = capsys.readouterr().out
+	assert "ERROR: no stars loaded from" in out
+
+
+def test_members_are_weighted_and_filtered(tmp_path):
+	datafile = tmp_path / "mem.txt"
+	datafile.write_text("# RA Dec magB magV magB_err magV_err pmem\n"
+		"1 2 12.5 12.0 0.01 0.01 0.9\n"
+		"1 2 13.5 13.0 0.01 0.01 0.1\n"
+		"1 2 14.8 14.0 0.02 0.02 0.6\n")
+	cmd = isofit.loaddata(str(datafile), pmin=0.5)
+	assert cmd.v == [12.0, 14.0]
+	assert cmd.weight == [0.9, 0.6]
+	assert np.allclose(cmd.bv, [0.5, 0.8])
+
+
+def test_hess_fit_recovers_the_distance():
+	models = isofit.loadmodels(os.path.join(ROOT, "PadovaCMD.dat"))
+	model = models[len(models)//2]
+	# Stars drawn along the model isochrone, shifted to a distance modulus of 10
+	rng = np.random.default_rng(14)
+	bv, v, weight = model.sample(0.01)
+	pick = rng.choice(len(v), 2000, p=np.asarray(weight)/np.sum(weight))
+	cmd = isofit.CMDdata("test")
+	for b, m in zip(bv[pick] + 0.2 + rng.normal(0, 0.02, 2000), v[pick] + 10. + model.R*0.2 + rng.normal(0, 0.02, 2000)):
+		cmd.add_point(b + m, m)
+	hess = isofit.HessDiagram(cmd, binsize=(0.05, 0.1), background=0.05)
+	modid, dist, ext, lnl = hess.fit([model], np.arange(8.0, 12.01, 0.1), np.arange(0.0, 0.41, 0.05))
+	assert abs(dist - 10.) < 0.25
+	assert abs(ext - 0.2) < 0.06
@@ -0,0 +1,73 @@
+# © 2020 University of Oxford - Department of Physics
+# Physics Practical Course AS35 - Colour-magnitude diagrams of open clusters
+# Tests of the field star decontamination
+
+import importlib
+import sys
+import numpy as np
+import pytest
+from astropy import wcs
+
+
+@pytest.fixture
+def membership(monkeypatch):
+	# The script parses its settings from the command line when imported
+	monkeypatch.setattr(sys, "argv", ["membership.py"])
+	monkeypatch.delenv("AS35_CONFIG", raising=False)
+	return importlib.import_module("membership")
+
+
+def image_wcs(ra, dec, size, scale=2.0):
+	w = wcs.WCS(naxis=2)
+	w.wcs.ctype = ["RA---TAN", "DEC--TAN"]
+	w.wcs.crpix = [size/2. + 0.5, size/2. + 0.5]
+	w.wcs.crval = [ra, dec]
+	w.wcs.cdelt = [-scale/3600., scale/3600.]
+	return w
+
+
+def test_areas_of_regions_inside_the_image(membership):
+	# A 30' x 30' image centred on the cluster
+	footprint = np.ones((900, 900), dtype=bool)
+	w = image_wcs(30., 40., 900)
+	inside = lambda ra, dec: membership.separation(ra, dec, 30., 40.) <= 5.
+	annulus = lambda ra, dec: (membership.separation(ra, dec, 30., 40.) >= 8.) & (membership.separation(ra, dec, 30., 40.) <= 12.)
+	assert abs(membership.covered_area(inside, [(footprint, w)]) - np.pi*25.) < 0.5
+	assert abs(membership.covered_area(annulus, [(footprint, w)]) - np.pi*80.) < 1.
+
+
+def test_areas_are_limited_by_the_footprints(membership):
+	footprint = np.ones((900, 900), dtype=bool)
+	# the half of the first image east of the centre has no data
+	footprint[:, :450] = False
+	w = image_wcs(30., 40., 900)
+	# and the second image only covers the north of the cluster
+	other = np.ones((450, 900), dtype=bool)
+	other_wcs = image_wcs(30., 40. + 7.5/60., 900)
+	other_wcs.wcs.crpix = [450.5, 225.5]
+	inside = lambda ra, dec: membership.separation(ra, dec, 30., 40.) <= 5.
+	assert abs(membership.covered_area(inside, [(footprint, w)], step=1) - np.pi*25./2) < 0.5
+	assert abs(membership.covered_area(inside, [(footprint, w), (other, other_wcs)], step=1) - np.pi*25./4) < 0.5
+
+
+def test_cluster_sequence_stands_out_of_the_field(membership):
+	rng = np.random.default_rng(15)
+	# Field stars uniform in the CMD over the cluster and field regions, with
+	# a field region twice as large as the cluster region
+	nfield = 3000
+	colour = rng.uniform(0., 2., nfield)
+	mag = rng.uniform(10., 18., nfield)
+	region = rng.uniform(0., 3., nfield)
+	cluster = region < 1.
+	field = region >= 1.
+	# and cluster members along a narrow sequence
+	members = 300
+	mag_members = rng.uniform(10., 18., members)
+	colour = np.concatenate([colour, 0.1*(mag_members - 10.) + rng.normal(0., 0.02, members)])
+	mag = np.concatenate([mag, mag_members])
+	cluster = np.concatenate([cluster, np.ones(members, dtype=bool)])
+	field = np.concatenate([field, np.zeros(members, dtype=bool)])
+	pmem = membership.membership(colour, mag, cluster, field, 1., 2.)
+	assert np.all(pmem[field] == 0)
+	assert np.median(pmem[-members:]) > 0.5
+	assert np.median(pmem[:nfield][cluster[:nfield]]) < 0.3
@@ -0,0 +1,56 @@
+# © 2020 University of Oxford - Department of Physics
+# Physics Practical Course AS35 - Colour-magnitude diagrams of open clusters
+# Tests of the bias statistics
+
+import os
+import subprocess
+import sys
+import numpy as np
+from astropy.io import fits
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "plot_bias.py")
+
+
+def test_bias_profiles(tmp_path):
+	rng = np.random.default_rng(5)
+	levels = [1000., 1002., 1010.]
+	with open(tmp_path / "bias_files.txt", "w") as f:
+		for i, level in enumerate(levels):
+			data = rng.normal(level, 3., (40, 60)).astype(np.float32)
+			data[:, 10] += 50.
+			hdu = fits.PrimaryHDU(data)
+			hdu.header["IMAGETYP"] = "Bias Frame"
+			hdu.writeto(tmp_path / ("bias_" + str(i) + ".fits"))
+			f.write("bias_" + str(i) + ".fits\n")
+	subprocess.run([sys.executable, SCRIPT, "--no-plot"], cwd=tmp_path, check=True, capture_output=True)
+
+	with fits.open(tmp_path / "bias_stats.fits") as hdulist:
+		columns = hdulist["COLUMNS"].data
+		profiles = hdulist["COLPROF"].data
+		assert hdulist[0].header["NFRAMES"] == 3
+		assert profiles.shape == (3, 60)
+		assert abs(np.median(columns["mean"]) - np.mean(levels)) < 0.5
+		assert abs(columns["median_of_means"][10] - columns["median_of_means"][20] - 50.) < 3.
+		# The column pattern keeps the hot column, not the smooth structure
+		assert np.argmax(columns["pattern"]) == 10
+		# The robust profile is the median of the saved per-frame profiles
+		assert np.allclose(columns["median_of_means"], np.median(profiles, axis=0))
+
+
+def test_robust_profile_ignores_a_deviant_frame(tmp_path):
+	rng = np.random.default_rng(6)
+	with open(tmp_path / "bias_files.txt", "w") as f:
+		for i in range(5):
+			data = rng.normal(1000., 3., (30, 20)).astype(np.float32)
+			if i == 1:
+				data += 200.
+			hdu = fits.PrimaryHDU(data)
+			hdu.header["IMAGETYP"] = "Bias Frame"
+			hdu.writeto(tmp_path / ("bias_" + str(i) + ".fits"))
+			f.write("bias_" + str(i) + ".fits\n")
+	subprocess.run([sys.executable, SCRIPT, "--no-plot"], cwd=tmp_path, check=True, capture_output=True)
+
+	with fits.open(tmp_path / "bias_stats.fits") as hdulist:
+		rows = hdulist["ROWS"].data
+		assert np.all(np.abs(rows["median_of_means"] - 1000.) < 3.)
+		assert np.all(np.abs(rows["mean"] - 1040.) < 3.)
@@ -0,0 +1,76 @@
+# © 2020 University of Oxford - Department of Physics
+# Physics Practical Course AS35 - Colour-magnitude diagrams of open clusters
+# Tests of the PSF photometry
+
+import numpy as np
+from psf_photometry import select_psf_stars, build_epsf, group_stars, fit_group, psf_photometry
+
+
+def test_isolated_stars_are_preferred():
+	data = np.ones((200, 200))
+	xpix = np.array([50., 150., 100., 108.])
+	ypix = np.array([50., 150., 100., 100.])
+	selected = select_psf_stars(data, xpix, ypix, size=25, min_stars=2)
+	assert sorted(selected) == [0, 1]
+
+
+def test_isolation_radius_is_relaxed_in_crowded_fields():
+	# Stars on a grid 12 pixels apart: none has a neighbour further than the
+	# 25 pixel cutout, but they are isolated enough at half that radius
+	data = np.ones((300, 300))
+	yy, xx = np.mgrid[30:270:12, 30:270:12]
+	selected = select_psf_stars(data, xx.ravel().astype(float), yy.ravel().astype(float), size=25)
+	assert len(selected) >= 10
+	assert len(select_psf_stars(data, xx.ravel().astype(float), yy.ravel().astype(float), size=25, min_radius=25)) == 0
+
+
+def star_field(rng):
+	# Gaussian stars (sigma 1.5 pixels) on a flat sky with a blended pair
+	# 3 pixels apart, and bright isolated stars to build the PSF from
+	ny, nx = 200, 200
+	yy, xx = np.mgrid[0:ny, 0:nx]
+	x = np.array([40.3, 160.2, 40.6, 160.8, 100.2, 103.1, 70.4])
+	y = np.array([40.7, 40.1, 160.4, 160.9, 100.6, 100.3, 130.2])
+	flux = np.array([80000., 80000., 80000., 80000., 50000., 30000., 10000.])
+	data = np.full((ny, nx), 100.)
+	for xs, ys, fs in zip(x, y, flux):
+		data += fs/(2*np.pi*1.5**2)*np.exp(-((xx - xs)**2 + (yy - ys)**2)/(2*1.5**2))
+	variance = data.copy()
+	data = data + rng.normal(0., 1., data.shape)*np.sqrt(variance)
+	return data - 100., variance, x, y, flux
+
+
+def test_psf_photometry_recovers_blended_fluxes():
+	rng = np.random.default_rng(4)
+	data, variance, x, y, flux = star_field(rng)
+	psf = build_epsf(data, x[:4], y[:4], size=25)
+	assert psf is not None
+
+	# The blended pair is fitted as one group
+	groups = group_stars(x, y, 12.)
+	assert sorted(len(group) for group in groups) == [1, 1, 1, 1, 1, 2]
+
+	# Start from positions offset by a fraction of a pixel
+	x0 = x + rng.uniform(-0.5, 0.5, len(x))
+	y0 = y + rng.uniform(-0.5, 0.5, len(y))
+	fluxes, errors = psf_photometry(data, x0, y0, psf, variance=variance, workers=1)
+	assert np.all(np.abs(fluxes[4:]/flux[4:] - 1.) < 0.03)
+	assert np.all(np.isfinite(errors)) and np.all(errors > 0)
+
+	# The same results in batches fitted by a process pool
+	pooled, _ = psf_photometry(data, x0, y0, psf, variance=variance, workers=2, batch_size=2)
+	assert np.allclose(pooled, fluxes)
+
+
+def test_fit_group_recenters():
+	rng = np.random.default_rng(5)
+	data, variance, x, y, flux = star_field(rng)
+	psf = build_epsf(data, x[:4], y[:4], size=25)
+	psf_dy, psf_dx = np.gradient(psf)
+	cutout = data[85:116, 85:120]
+	fitted = fit_group(cutout, variance[85:116, 85:120], x[4:6] - 85 + 0.6, y[4:6] - 85 - 0.6, psf, psf_dx, psf_dy, 6., recenter=3)
+	flux_fit, flux_err, x_fit, y_fit = fitted
+	# the shifts move the stars back to their true positions
+	assert np.all(np.abs(x_fit - (x[4:6] - 85)) < 0.1)
+	assert np.all(np.abs(y_fit - (y[4:6] - 85)) < 0.1)
+	assert np.all(np.abs(flux_fit/flux[4:6] - 1.) < 0.03)
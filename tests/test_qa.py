@@ -0,0 +1,57 @@
+# © 2020 University of Oxford - Department of Physics
+# Physics Practical Course AS35 - Colour-magnitude diagrams of open clusters
+# Tests of the quality checks of the calibration frames
+
+import json
+import os
+import subprocess
+import sys
+import numpy as np
+from astropy.io import fits
+from astropy.stats import sigma_clipped_stats
+from qa import region_stats, check_frames
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_region_statistics_match_the_regions():
+	rng = np.random.default_rng(6)
+	frame = rng.normal(100., 2., (64, 48))
+	frame[5, 5] = 1000.
+	means, medians, stds = region_stats(frame, (4, 3))
+	assert medians.shape == (4, 3)
+	mean, median, std = sigma_clipped_stats(frame[:16, :16], sigma=3.0, maxiters=5)
+	assert np.isclose(means[0, 0], mean, rtol=1e-5)
+	assert np.isclose(medians[0, 0], median, rtol=1e-5)
+	assert np.isclose(stds[0, 0], std, rtol=1e-4)
+
+
+def test_deviant_frame_is_flagged():
+	rng = np.random.default_rng(7)
+	frames = [rng.normal(100., 2., (64, 64)) for i in range(6)]
+	# a light leak in one corner of one frame
+	frames[2][:16, :16] += 40.
+	stats = [region_stats(frame) for frame in frames]
+	report, flags = check_frames(stats, ["f" + str(i) for i in range(6)])
+	assert list(np.nonzero(flags)[0]) == [2]
+	assert report[2]["flagged"] and report[2]["max_score"] > 10.
+	assert abs(report[0]["median"] - 100.) < 1.
+
+
+def test_combine_bias_rejects_the_deviant_frame(tmp_path):
+	rng = np.random.default_rng(8)
+	with open(tmp_path / "bias_files.txt", "w") as f:
+		for i in range(5):
+			data = rng.normal(1000., 3., (32, 32)).astype(np.float32)
+			if i == 3:
+				data += 100.
+			hdu = fits.PrimaryHDU(data)
+			hdu.header["IMAGETYP"] = "Bias Frame"
+			hdu.writeto(tmp_path / ("bias_" + str(i) + ".fits"))
+			f.write("bias_" + str(i) + ".fits\n")
+	subprocess.run([sys.executable, os.path.join(ROOT, "combine_bias.py")], cwd=tmp_path, check=True, capture_output=True)
+
+	with open(tmp_path / "master" / "qa_bias.json") as f:
+		report = json.load(f)
+	assert [frame["flagged"] for frame in report["frames"]] == [False, False, False, True, False]
+	assert abs(np.mean(fits.getdata(tmp_path / "master" / "master_bias.fits")) - 1000.) < 1.
@@ -0,0 +1,69 @@
+# © 2020 University of Oxford - Department of Physics
+# Physics Practical Course AS35 - Colour-magnitude diagrams of open clusters
+# Tests of the registration of the frames
+
+import numpy as np
+from ccdproc import CCDData
+from astropy import wcs
+from astropy import units as u
+from register import detect_bright_stars, match_offset, apply_correction
+
+
+def frame_wcs():
+	w = wcs.WCS(naxis=2)
+	w.wcs.ctype = ["RA---TAN", "DEC--TAN"]
+	w.wcs.crpix = [50., 50.]
+	w.wcs.crval = [10., 60.]
+	w.wcs.cd = [[-1./3600, 0.], [0., 1./3600]]
+	return w
+
+
+def test_correction_of_a_frame_written_by_ccddata(tmp_path):
+	filename = str(tmp_path / "frame.fits")
+	CCDData(np.zeros((100, 100), dtype=np.float32), unit=u.adu/u.s, wcs=frame_wcs()).write(filename)
+	ccd = CCDData.read(filename)
+	# CCDData.read moves the WCS keywords out of the header
+	assert "CRVAL1" not in ccd.header
+	ra0, dec0 = ccd.wcs.all_pix2world(20., 30., 0)
+	apply_correction(ccd, 1e-3, -2e-3)
+	ra1, dec1 = ccd.wcs.all_pix2world(20., 30., 0)
+	assert abs(dec1 - dec0 + 2e-3) < 1e-9
+	assert abs(ra1 - ra0 - 1e-3) < 1e-6
+
+
+def test_corrected_frame_reprojects_onto_the_reference(tmp_path):
+	from reproject import reproject_interp
+
+	yy, xx = np.mgrid[0:100, 0:100]
+	star = np.exp(-((xx - 40.)**2 + (yy - 60.)**2)/4.).astype(np.float32)
+	filename = str(tmp_path / "frame.fits")
+	CCDData(star, unit=u.adu/u.s, wcs=frame_wcs()).write(filename)
+	ccd = CCDData.read(filename)
+	# The star is 5 pixels too far north according to the header WCS
+	apply_correction(ccd, 0., -5./3600)
+	reference = frame_wcs().to_header()
+	reference["NAXIS"] = 2
+	reference["NAXIS1"] = 100
+	reference["NAXIS2"] = 100
+	data, footprint = reproject_interp((ccd.data, ccd.wcs), reference)
+	y, x = np.unravel_index(np.nanargmax(data), data.shape)
+	assert (x, y) == (40, 55)
+
+
+def test_offset_between_star_lists():
+	rng = np.random.default_rng(3)
+	xref = rng.uniform(0, 500, 50)
+	yref = rng.uniform(0, 500, 50)
+	dx, dy, nmatch = match_offset(xref - 7.3, yref + 4.1, xref, yref)
+	assert abs(dx - 7.3) < 0.05 and abs(dy + 4.1) < 0.05
+	assert nmatch == 50
+
+
+def test_bright_star_detection():
+	rng = np.random.default_rng(4)
+	data = rng.normal(0., 1., (100, 100))
+	yy, xx = np.mgrid[0:100, 0:100]
+	for x, y in [(20, 30), (70, 80)]:
+		data += 500.*np.exp(-((xx - x)**2 + (yy - y)**2)/4.)
+	xpix, ypix = detect_bright_stars(data)
+	assert sorted(np.round(xpix).astype(int)) == [20, 70]
@@ -0,0 +1,45 @@
+# © 2020 University of Oxford - Department of Physics
+# Physics Practical Course AS35 - Colour-magnitude diagrams of open clusters
+# Tests of the rasterized plots
+
+import numpy as np
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+import render
+import isofit
+
+
+def test_decimate_is_repeatable():
+	keep = render.decimate(1000, 100)
+	assert len(keep) == 100 and len(np.unique(keep)) == 100
+	assert np.array_equal(keep, render.decimate(1000, 100))
+	assert np.array_equal(render.decimate(50, 100), np.arange(50))
+
+
+def test_density_image_counts_every_point():
+	rng = np.random.default_rng(12)
+	x = rng.normal(0., 1., 10000)
+	y = rng.normal(0., 1., 10000)
+	x[0] = np.nan
+	image, extent = render.density_image(x, y, bins=(50, 40), range=[[-10, 10], [-10, 10]])
+	assert image.shape == (40, 50)
+	assert image.sum() == 9999
+
+
+def large_cmd(nstars):
+	rng = np.random.default_rng(13)
+	cmd = isofit.CMDdata("test")
+	for v, bv in zip(rng.uniform(10., 18., nstars), rng.uniform(0., 1.5, nstars)):
+		cmd.add_point(v + bv, v)
+	return cmd
+
+
+def test_large_cmd_is_decimated_for_interactive_views():
+	cmd = large_cmd(3000)
+	cmd.plot(max_points=500, decimate=True)
+	lines = plt.gca().get_lines()
+	assert len(lines) == 1 and len(lines[0].get_xdata()) == 500
+	cmd.plot(max_points=500)
+	assert len(plt.gca().get_lines()) == 0 and len(plt.gca().get_images()) == 1
+	plt.close()
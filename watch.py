@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+
+# © 2020 University of Oxford - Department of Physics
+# Physics Practical Course AS35 - Colour-magnitude diagrams of open clusters
+# Quick-look reduction of the science frames while observing
+
+# Import Python Libraries
+import glob, os
+import sys
+import time
+import config
+
+# EDIT the settings in a run file (--config run.toml) or on the command line
+settings = config.load("watch", {
+	# Name of the cluster, and the directory of the raw frames (the name of the cluster if none)
+	"target": "NGC6939",
+	"raw_dir": None,
+	# Seconds between two scans of the directory; a new file is reduced once
+	# its size has not changed between two scans
+	"poll_interval": 2.0,
+	# Detector gain (e-/ADU), read noise (e-), saturation level (ADU) and
+	# cosmic ray threshold, as in reduce_frames.py
+	"gain": 1.0,
+	"read_noise": 10.0,
+	"saturation": 50000.0,
+	"cosmic_sigclip": 5.0,
+	# Weights of the frames in the quick-look coadd: "exposure" or "variance"
+	"weighting": "exposure",
+	# Margin (pixels) added around the first frame of each filter for the coadd
+	"margin": 100,
+	# Detection threshold (in sigma) of the quick-look star count
+	"detect_nsigma": 10.0,
+	# Reduce the frames already there and stop, instead of watching
+	"once": False,
+}, "Reduce the raw frames of a target as they arrive and coadd them")
+target = settings.target
+raw_dir = settings.raw_dir if settings.raw_dir is not None else target
+
+from ccdproc import CCDData
+from astropy.nddata import VarianceUncertainty
+from astropy.io import fits
+from astropy import units as u
+import numpy as np
+from reduction import frame_name, frame_inputs, read_masters, read_flat, calibrate_frame
+from coadd import RunningCoadd
+from register import detect_bright_stars
+from checkpoint import Journal, write_fits
+import warnings
+from astropy.utils.exceptions import AstropyWarning
+warnings.simplefilter('ignore', category=AstropyWarning)
+warnings.filterwarnings('ignore')
+
+
+class QuickLook() :	# Running coadd of one filter on a fixed grid
+
+	def __init__(self, ccd, margin=100):
+		# The grid is the first frame extended by margin pixels on each side
+		self.header = ccd.wcs.to_header()
+		self.header["NAXIS"] = 2
+		self.header["NAXIS1"] = ccd.data.shape[1] + 2*margin
+		self.header["NAXIS2"] = ccd.data.shape[0] + 2*margin
+		self.header["CRPIX1"] += margin
+		self.header["CRPIX2"] += margin
+		self.coadd = RunningCoadd((self.header["NAXIS2"], self.header["NAXIS1"]))
+		self.exptime = 0.
+
+	def add(self, ccd, weighting="exposure"):
+		'''
+		Reproject a calibrated frame onto the grid and add it to the coadd.
+		'''
+		# reproject is slow to import, and only needed here
+		from reproject import reproject_interp
+
+		data, footprint = reproject_interp((ccd.data, ccd.wcs), self.header)
+		variance = None
+		if ccd.uncertainty is not None:
+			variance, _ = reproject_interp((ccd.uncertainty.represent_as(VarianceUncertainty).array, ccd.wcs), self.header)
+
+		# Same weights as combine_sci.py
+		if weighting == "variance" and variance is not None:
+			with np.errstate(divide='ignore'):
+				weight = 1./variance
+		else:
+			weight = footprint*ccd.header["EXPTIME"]
+		self.coadd.add(data, weight, variance)
+		self.exptime += ccd.header["EXPTIME"]
+
+	def count_stars(self, nsigma=10.0):
+		'''
+		Number of stars detected in the coadd, ignoring the pixels without data
+		(the detection takes NaN for saturated pixels).
+		'''
+		mean, weight, variance = self.coadd.result()
+		xpix, ypix = detect_bright_stars(mean, nsigma=nsigma, nmax=mean.size, mask=(weight == 0))
+		return len(xpix)
+
+	def write(self, filename):
+		mean, weight, variance = self.coadd.result()
+		hdu = fits.HDUList([fits.PrimaryHDU(mean, header=self.header)])
+		hdu[0].header["NCOMBINE"] = self.coadd.nframes
+		hdu[0].header["EXPTIME"] = self.exptime
+		hdu.append(fits.ImageHDU(variance, name="UNCERT"))
+		hdu["UNCERT"].header["UTYPE"] = "VarianceUncertainty"
+		hdu.append(fits.ImageHDU(weight, name="WEIGHT"))
+		write_fits(hdu, filename)
+
+
+def stable_files(sizes):
+	'''
+	Raw frames whose size has not changed since the previous scan, i.e. that
+	are completely written. sizes is updated with the sizes of this scan.
+	'''
+	stable = []
+	for filename in sorted(glob.glob(raw_dir + "/" + target + "*")):
+		try:
+			size = os.path.getsize(filename)
+		except OSError:
+			continue
+		if sizes.get(filename) == size and size > 0:
+			stable.append(filename)
+		sizes[filename] = size
+	return stable
+
+
+if __name__ == "__main__":
+	# Read the master frames once
+	master_bias, master_dark, hot_pixels = read_masters()
+	master_flats = {}
+
+	# Create the output directories if needed
+	for directory in [target + "_frames", target + "_quicklook"]:
+		if not os.path.exists(directory):
+			os.makedirs(directory)
+
+	# Frames reduced by a previous run (or by reduce_frames.py) are not
+	# reduced again, but added to the coadds
+	quicklooks = {}
+	processed = set()
+	for filename in sorted(glob.glob(target + "_frames/" + target + "_*.fits")):
+		ccd = CCDData.read(filename)
+		processed.add(ccd.header.get("RAWFILE", ""))
+		filter_name = ccd.header["FILTER"].strip()
+		if filter_name not in quicklooks:
+			quicklooks[filter_name] = QuickLook(ccd, settings.margin)
+		quicklooks[filter_name].add(ccd, settings.weighting)
+	if len(processed) > 0:
+		print ("Found " + str(len(processed)) + " reduced frames")
+
+	# The reduced frames are recorded in the journal of reduce_frames.py, so
+	# that it does not reduce them again
+	journal = Journal("reduce_frames", target + "_frames")
+	parameters = [settings.gain, settings.read_noise, settings.saturation, settings.cosmic_sigclip]
+
+	sizes = {}
+	print ("Watching " + raw_dir + " for new frames")
+	while True:
+		start = time.time()
+		for sci in stable_files(sizes):
+			if sci in processed:
+				continue
+			processed.add(sci)
+
+			# Calibrate the new frame with the preloaded masters
+			ccd = CCDData.read(sci, unit = u.adu)
+			filter_name = ccd.header["FILTER"].strip()
+			if filter_name not in master_flats:
+				master_flats[filter_name] = read_flat(filter_name)
+			master_flat, flat_squared = master_flats[filter_name]
+			ccd = calibrate_frame(ccd, master_bias, master_dark, master_flat, flat_squared, hot_pixels, settings.gain, settings.read_noise, settings.saturation, settings.cosmic_sigclip)
+			ccd.header['RAWFILE'] = sci
+
+			# Save it under the same name as reduce_frames.py would
+			output = frame_name(target, filter_name, sci)
+			write_fits(ccd, output)
+			journal.record(output, frame_inputs(sci, filter_name), parameters)
+
+			# Update the coadd and the quick-look
+			if filter_name not in quicklooks:
+				quicklooks[filter_name] = QuickLook(ccd, settings.margin)
+			quicklook = quicklooks[filter_name]
+			quicklook.add(ccd, settings.weighting)
+			quicklook.write(target + "_quicklook/" + target + "_" + filter_name + "_quicklook.fits")
+			nstars = quicklook.count_stars(settings.detect_nsigma)
+			print (os.path.basename(sci) + " -> " + output + ": " + filter_name + " coadd of " + str(quicklook.coadd.nframes) + " frames, " + '{:.0f}'.format(quicklook.exptime) + " s, " + str(nstars) + " stars (" + '{:.1f}'.format(time.time() - start) + " s)")
+			start = time.time()
+
+		if settings.once and all(filename in processed for filename in sizes):
+			break
+		time.sleep(settings.poll_interval)